@@ -26,19 +26,30 @@ class FSWriteContent:
     def __init__(self, *path_parts):
         self.path = os.path.join(*path_parts)
 
-    def write(self, python_obj):
-        """Write the object as json to disk"""
-        logger.debug("Writing %s", self.path)
+    def _make_dirs(self):
         dir_path = os.path.split(self.path)[0]
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
+    def write(self, python_obj):
+        """Write the object as json to disk"""
+        logger.debug("Writing %s", self.path)
+        self._make_dirs()
+
         with open(self.path, 'w') as out:
             text = AmendmentNodeEncoder(
                 sort_keys=True, indent=4,
                 separators=(', ', ': ')).encode(python_obj)
             out.write(text)
 
+    def write_stream(self, stream):
+        """Copy already-serialized json to disk"""
+        logger.debug("Writing %s", self.path)
+        self._make_dirs()
+
+        with open(self.path, 'wb') as out:
+            shutil.copyfileobj(stream, out)
+
 
 class APIWriteContent:
     """This writer writes the contents to the specified API"""
@@ -53,6 +64,12 @@ class APIWriteContent:
             data=AmendmentNodeEncoder().encode(python_obj),
             headers={'content-type': 'application/json'})
 
+    def write_stream(self, stream):
+        """Send already-serialized json to the API"""
+        logger.debug("Writing %s", self.path)
+        requests.post(self.path, data=stream,
+                      headers={'content-type': 'application/json'})
+
 
 class GitWriteContent:
     """This writer places the content in a git repo on the file system"""
@@ -126,6 +143,11 @@ class GitWriteContent:
             # Commit with the notice id as the commit message
             repo.index.commit(version_id)
 
+    def write_stream(self, stream):
+        """Only regulation trees are stored in git and those are always
+        written as objects; like `write`, ignore anything else"""
+        logger.debug("Writing %s", self.path)
+
 
 class Client:
     """A Client for writing regulation(s) and meta data."""
@@ -39,11 +39,12 @@ def process_if_needed(cfr_title, cfr_part, last_versions):
     version_path = entry.Version(cfr_title, cfr_part)
     deps = dependency.Graph()
 
-    for last_version in last_versions:
-        deps.add(tree_path / last_version.version_id,
-                 version_path / last_version.version_id)
-        deps.add(tree_path / last_version.version_id,
-                 annual_path / last_version.year)
+    with deps.batch():
+        for last_version in last_versions:
+            deps.add(tree_path / last_version.version_id,
+                     version_path / last_version.version_id)
+            deps.add(tree_path / last_version.version_id,
+                     annual_path / last_version.year)
 
     for last_version in last_versions:
         tree_entry = tree_path / last_version.version_id
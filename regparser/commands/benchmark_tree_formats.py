@@ -0,0 +1,97 @@
+import json
+import timeit
+
+import click
+
+try:
+    import tracemalloc
+except ImportError:     # Python 2
+    tracemalloc = None
+
+from regparser.index import entry
+from regparser.tree import packed
+from regparser.tree.struct import (
+    frozen_node_decode_hook, full_node_decode_hook, FullNodeEncoder)
+
+
+def _json_encode(tree):
+    encoder = FullNodeEncoder(
+        sort_keys=True, indent=4, separators=(', ', ': '))
+    return encoder.encode(tree).encode('utf-8')
+
+
+def _json_decoder(hook):
+    return lambda content: json.loads(content.decode('utf-8'),
+                                      object_hook=hook)
+
+
+FORMATS = (
+    # name, encode, decode (full), decode (frozen)
+    ('json', _json_encode, _json_decoder(full_node_decode_hook),
+     _json_decoder(frozen_node_decode_hook)),
+    ('packed', packed.encode, packed.decode_full, packed.decode_frozen),
+)
+
+
+def memory_of(decode, encoded):
+    """Bytes allocated (and still held) by a decoded tree. None if we can't
+    trace allocations"""
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return None
+    tracemalloc.start()
+    try:
+        tree = decode(encoded)
+        memory, _ = tracemalloc.get_traced_memory()
+        del tree
+    finally:
+        tracemalloc.stop()
+    return memory
+
+
+def measure(tree, repeat):
+    """Best time (over `repeat` runs) to encode, decode and decode into
+    FrozenNodes in each format, along with the encoded size and the memory
+    held by the decoded tree"""
+    for name, encode, decode_full, decode_frozen in FORMATS:
+        encoded = encode(tree)
+        yield {
+            'format': name,
+            'size': len(encoded),
+            'memory': memory_of(decode_full, encoded),
+            'encode': min(timeit.repeat(
+                lambda: encode(tree), number=1, repeat=repeat)),
+            'decode': min(timeit.repeat(
+                lambda: decode_full(encoded), number=1, repeat=repeat)),
+            'decode_frozen': min(timeit.repeat(
+                lambda: decode_frozen(encoded), number=1, repeat=repeat)),
+        }
+
+
+@click.command()
+@click.argument('cfr_title', type=int)
+@click.argument('cfr_part', type=int)
+@click.option('--version_id', help="Defaults to the last known version")
+@click.option('--repeat', type=int, default=5)
+def benchmark_tree_formats(cfr_title, cfr_part, version_id, repeat):
+    """Compare the size, speed and memory use of the tree serialization
+    formats (see the EREGS_TREE_FORMAT setting), using a tree from the
+    index."""
+    tree_dir = entry.Tree(cfr_title, cfr_part)
+    if version_id is None:
+        version_ids = [
+            version.path[-1]
+            for version in entry.Version(cfr_title, cfr_part).sub_entries()
+            if (tree_dir / version.path[-1]).exists()]
+        if not version_ids:
+            raise click.UsageError("No trees for this part in the index")
+        version_id = version_ids[-1]
+    tree = (tree_dir / version_id).read()
+
+    click.echo("{:<8} {:>12} {:>10} {:>10} {:>14} {:>14}".format(
+        'format', 'size (bytes)', 'encode (s)', 'decode (s)',
+        'decode frozen', 'memory (bytes)'))
+    for result in measure(tree, repeat):
+        if result['memory'] is None:
+            result['memory'] = 'n/a'
+        click.echo("{format:<8} {size:>12} {encode:>10.4f} {decode:>10.4f} "
+                   "{decode_frozen:>14.4f} {memory:>14}".format(**result))
@@ -2,6 +2,7 @@ import os
 import click
 from django.conf import settings
 
+from regparser.commands.collect_garbage import delete_unreferenced_blobs
 from regparser.index.http_cache import http_client
 from regparser.web.index.models import DependencyNode
 
@@ -26,5 +27,6 @@ def clear(path):
             DependencyNode.objects.filter(pk__startswith=path).delete()
     else:
         DependencyNode.objects.all().delete()
+    delete_unreferenced_blobs()
 
     http_client().cache.clear()
@@ -0,0 +1,27 @@
+import logging
+
+import click
+
+from regparser.index import storage
+from regparser.web.index.models import Blob
+
+logger = logging.getLogger(__name__)
+
+
+def delete_unreferenced_blobs():
+    """Entry contents are shared between entries; delete those which are no
+    longer referenced by any entry"""
+    unreferenced = Blob.objects.filter(entries__isnull=True)
+    outside_db = list(unreferenced.exclude(storage='db').values_list(
+        'digest', 'codec', 'storage'))
+    deleted, _ = unreferenced.delete()
+    for fields in outside_db:
+        storage.delete(*fields)
+    logger.info("Deleted %s unreferenced blobs", deleted)
+
+
+@click.command()
+def collect_garbage():
+    """Free space in the index. Removes the stored contents of entries which
+    have since been overwritten or deleted."""
+    delete_unreferenced_blobs()
@@ -1,36 +1,288 @@
+from collections import OrderedDict
 import click
 import logging
+import multiprocessing
+import traceback
+
+from django.db import connections
 
 from regparser.diff.tree import changes_between
-from regparser.index import dependency, entry
+from regparser.index import dependency, entry, executor
+from regparser.tree.struct import FrozenNode
+from regparser.web.index.models import Entry as DBEntry
 
 logger = logging.getLogger(__name__)
 
+# Which pairs of versions to precompute diffs for; see `version_pairs`
+PAIRS = ('all', 'adjacent', 'latest')
+
+
+def in_version_order(cfr_title, cfr_part, version_ids):
+    """Sort version ids by their associated versions. Ids without versions
+    are placed at the end"""
+    version_ids = set(version_ids)
+    ordered = [version.path[-1]
+               for version in entry.Version(cfr_title, cfr_part).sub_entries()
+               if version.path[-1] in version_ids]
+    return ordered + sorted(version_ids - set(ordered))
+
+
+def version_pairs(version_ids, pairs=('all',)):
+    """Pairs of version ids (in version order) which should be diffed:
+    * 'all' - every version against every version (including itself)
+    * 'adjacent' - each version against the next
+    * 'latest' - each version against the last
+    Other pairs can be computed when requested; see `diff_between`"""
+    unknown = set(pairs) - set(PAIRS)
+    if unknown:
+        raise ValueError("Unknown pairs: {}. Options: {}".format(
+            ', '.join(sorted(unknown)), ', '.join(PAIRS)))
+    version_ids = list(version_ids)
+    result = []
+    if 'all' in pairs:
+        result.extend((lhs_id, rhs_id) for lhs_id in version_ids
+                      for rhs_id in version_ids)
+    if 'adjacent' in pairs:
+        result.extend(zip(version_ids, version_ids[1:]))
+    if 'latest' in pairs:
+        result.extend((version_id, version_ids[-1])
+                      for version_id in version_ids[:-1])
+    seen = set()
+    return [pair for pair in result if not (pair in seen or seen.add(pair))]
+
+
+def diff_between(cfr_title, cfr_part, lhs_id, rhs_id, deps=None,
+                 trees=None):
+    """The diff between two versions' trees. If it's been computed (and is
+    up to date), it's read from the index; otherwise it's computed and
+    written to the index for next time. When requesting many diffs, share a
+    dependency graph (`deps`) and a dictionary of already-read trees
+    (`trees`, keyed by version id) between calls"""
+    if deps is None:
+        deps = dependency.Graph()
+    if trees is None:
+        trees = {}
+    tree_dir = entry.FrozenTree(cfr_title, cfr_part)
+    path = entry.Diff(cfr_title, cfr_part, lhs_id, rhs_id)
+    with deps.batch():
+        deps.add(path, tree_dir / lhs_id)
+        deps.add(path, tree_dir / rhs_id)
+
+    deps.validate_for(path)
+    if not deps.is_stale(path):
+        return path.read()
+
+    for version_id in (lhs_id, rhs_id):
+        if version_id not in trees:
+            trees[version_id] = (tree_dir / version_id).read()
+    diff = dict(changes_between(trees[lhs_id], trees[rhs_id]))
+    path.write(diff)
+    return diff
+
+
+def diff_group(tree_dir, pairs, trees):
+    """Diffs between each of these pairs of versions, as (lhs id, rhs id,
+    diff) triples. Trees are read as needed, and kept in `trees` (a
+    dictionary keyed by version id)"""
+    results = []
+    for lhs_id, rhs_id in pairs:
+        for version_id in (lhs_id, rhs_id):
+            if version_id not in trees:
+                trees[version_id] = (tree_dir / version_id).read()
+        results.append((lhs_id, rhs_id,
+                        dict(changes_between(trees[lhs_id], trees[rhs_id]))))
+    return results
+
+
+def _groups(pairs):
+    """Group pairs by whichever of their versions appears first, returning
+    (pairs, ids of the versions needed by later groups) tuples. A group's
+    versions are then its own plus those after it, so trees can be dropped
+    as soon as their group is done, even when diffing every pair"""
+    position = {}
+    for pair in pairs:
+        for version_id in pair:
+            position.setdefault(version_id, len(position))
+    groups = OrderedDict()
+    for pair in pairs:
+        first = min(pair, key=position.get)
+        groups.setdefault(first, []).append(pair)
+
+    needed, result = set(), []
+    for group in reversed(list(groups.values())):
+        result.append((group, frozenset(needed)))
+        needed.update(version_id for pair in group for version_id in pair)
+    return list(reversed(result))
+
+
+def _keep_only(trees, version_ids):
+    """Drop the trees which won't be needed again"""
+    for version_id in list(trees):
+        if version_id not in version_ids:
+            del trees[version_id]
+
+
+# Trees read by this worker process; see `_diff_group_in_worker`
+_worker_trees = {}
+
+
+def _init_worker():
+    _worker_trees.clear()
+
+
+def _diff_group_in_worker(args):
+    """Run within a worker process. Trees are kept between groups while a
+    later group may need them. As in the executor, exceptions are sent back
+    as text, as they may not survive being pickled"""
+    tree_dir, pairs, needed_later = args
+    try:
+        results = diff_group(tree_dir, pairs, _worker_trees)
+        _keep_only(_worker_trees, needed_later)
+        return results, None
+    except Exception:
+        return None, (pairs[0][0], traceback.format_exc())
+
+
+def compute_diffs(tree_dir, pairs, jobs=1):
+    """Generate (lhs id, rhs id, diff) triples for each of these pairs.
+    Pairs are grouped (see `_groups`) so that trees can be shared between
+    them and released once no longer needed. If `jobs` is greater than one,
+    groups are computed in that many worker processes, with results
+    generated as each group completes"""
+    groups = _groups(pairs)
+    if jobs <= 1 or len(groups) <= 1:
+        trees = {}
+        for group, needed_later in groups:
+            for result in diff_group(tree_dir, group, trees):
+                yield result
+            _keep_only(trees, needed_later)
+        return
+
+    # Each worker will need to open its own db connection
+    connections.close_all()
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+    success = False
+    try:
+        work = [(tree_dir, group, needed_later)
+                for group, needed_later in groups]
+        for results, error in pool.imap_unordered(_diff_group_in_worker,
+                                                  work):
+            if error:
+                lhs_id, details = error
+                raise executor.BuildFailed(tree_dir / lhs_id, details)
+            for result in results:
+                yield result
+        success = True
+    finally:
+        if success:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+# Trees kept between the groups built by `process_group` in this process,
+# as label -> (modification time, tree)
+_group_trees = {}
+
+
+def process_group(diff_entries, tree_dir, needed_later):
+    """Build and write these diffs, which make up one of the groups from
+    `_groups`. As in `compute_diffs`, trees are kept while a later group may
+    need them, though only reused if they haven't been rewritten since"""
+    pairs = [diff_entry.path[-2:] for diff_entry in diff_entries]
+    version_ids = set(version_id for pair in pairs for version_id in pair)
+    labels = {str(tree_dir / version_id): version_id
+              for version_id in version_ids}
+    label_list = list(labels)
+    modified = {}
+    for idx in range(0, len(label_list), dependency.QUERY_CHUNK_SIZE):
+        modified.update(DBEntry.objects.filter(
+            label_id__in=label_list[idx:idx + dependency.QUERY_CHUNK_SIZE]
+        ).values_list('label_id', 'modified'))
+
+    trees = {}
+    for label, version_id in labels.items():
+        cached = _group_trees.get(label)
+        if cached and cached[0] == modified.get(label):
+            trees[version_id] = cached[1]
+
+    diff_dir = entry.Diff(*tree_dir.path)
+    with entry.bulk_writer():
+        for lhs_id, rhs_id, diff in diff_group(tree_dir, pairs, trees):
+            (diff_dir / lhs_id / rhs_id).write(diff)
+
+    for label, version_id in labels.items():
+        _group_trees[label] = (modified.get(label), trees[version_id])
+    keep = set(str(tree_dir / version_id) for version_id in needed_later)
+    for label in list(_group_trees):
+        if label not in keep:
+            del _group_trees[label]
+
+
+def builders(deps, cfr_title, cfr_part, version_ids, pairs=('all',)):
+    """Add dependencies for the diffs between pairs of these versions' trees
+    (which need not exist yet), returning how to build each diff. See
+    `executor.build_stale` and `version_pairs`. Diffs are built in the
+    groups described in `_groups`, so each tree is read rarely"""
+    tree_dir = entry.FrozenTree(cfr_title, cfr_part)
+    diff_dir = entry.Diff(cfr_title, cfr_part)
+    version_ids = in_version_order(cfr_title, cfr_part, version_ids)
+    result = OrderedDict()
+    with deps.batch():
+        for group, needed_later in _groups(
+                version_pairs(version_ids, pairs)):
+            batch = executor.Batch(process_group, (tree_dir, needed_later))
+            for lhs_id, rhs_id in group:
+                path = diff_dir / lhs_id / rhs_id
+                deps.add(path, tree_dir / lhs_id)
+                deps.add(path, tree_dir / rhs_id)
+                result[path] = batch
+    return result
+
 
 @click.command()
 @click.argument('cfr_title', type=int)
 @click.argument('cfr_part', type=int)
-def diffs(cfr_title, cfr_part):
+@click.option('--pairs', type=click.Choice(PAIRS), multiple=True,
+              default=['all'],
+              help="Which pairs of versions to diff; may be repeated. Others "
+                   "can be computed on demand (see write_to)")
+@click.option('--jobs', type=int, default=1,
+              help="Number of processes used to compute diffs")
+def diffs(cfr_title, cfr_part, pairs, jobs):
     """Construct diffs between known trees."""
     logger.info("Build diffs - %s Part %s", cfr_title, cfr_part)
     tree_dir = entry.FrozenTree(cfr_title, cfr_part)
     diff_dir = entry.Diff(cfr_title, cfr_part)
-    pairs = [(l.path[-1], r.path[-1])
-             for l in tree_dir.sub_entries()
-             for r in tree_dir.sub_entries()]
+    version_ids = in_version_order(
+        cfr_title, cfr_part,
+        [tree.path[-1] for tree in tree_dir.sub_entries()])
+    pairs = version_pairs(version_ids, pairs)
     deps = dependency.Graph()
-    for lhs_id, rhs_id in pairs:
-        deps.add(diff_dir / lhs_id / rhs_id, tree_dir / lhs_id)
-        deps.add(diff_dir / lhs_id / rhs_id, tree_dir / rhs_id)
+    with deps.batch():
+        for lhs_id, rhs_id in pairs:
+            deps.add(diff_dir / lhs_id / rhs_id, tree_dir / lhs_id)
+            deps.add(diff_dir / lhs_id / rhs_id, tree_dir / rhs_id)
 
-    trees = {}
+    stale = []
     for lhs_id, rhs_id in pairs:
         path = diff_dir / lhs_id / rhs_id
         deps.validate_for(path)
         if deps.is_stale(path):
-            if lhs_id not in trees:
-                trees[lhs_id] = (tree_dir / lhs_id).read()
-            if rhs_id not in trees:
-                trees[rhs_id] = (tree_dir / rhs_id).read()
+            stale.append((lhs_id, rhs_id))
 
-            path.write(dict(changes_between(trees[lhs_id], trees[rhs_id])))
+    # Only this process writes
+    failure = None
+    with entry.bulk_writer():
+        try:
+            for lhs_id, rhs_id, diff in compute_diffs(tree_dir, stale, jobs):
+                (diff_dir / lhs_id / rhs_id).write(diff)
+        except executor.BuildFailed as exc:
+            # Keep the diffs which were computed before the failure
+            failure = exc
+    if failure:
+        raise failure
+    pool = FrozenNode._pool
+    logger.debug("Interned nodes: %d live, %d hits, %d misses", len(pool),
+                 pool.hits, pool.misses)
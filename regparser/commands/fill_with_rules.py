@@ -4,13 +4,13 @@ import logging
 import click
 
 from regparser.history.versions import Version
-from regparser.index import dependency, entry
+from regparser.index import dependency, entry, executor
 from regparser.notice.compiler import compile_regulation
 
 logger = logging.getLogger(__name__)
 
 
-def dependencies(tree_dir, version_dir, versions_with_parents):
+def dependencies(tree_dir, version_dir, versions_with_parents, deps=None):
     """Set up the dependency graph for this regulation. First calculates
     "gaps" -- versions for which there is no existing tree. In this
     calculation, we ignore the first version, as we won't be able to build
@@ -21,12 +21,14 @@ def dependencies(tree_dir, version_dir, versions_with_parents):
     gaps = [(version, parent) for (version, parent) in versions_with_parents
             if version.identifier not in existing_tree_ids]
 
-    deps = dependency.Graph()
-    for version, parent in gaps:
-        doc_number = version.identifier
-        deps.add(tree_dir / doc_number, tree_dir / parent.identifier)
-        deps.add(tree_dir / doc_number, entry.Notice(doc_number))
-        deps.add(tree_dir / doc_number, version_dir / doc_number)
+    if deps is None:
+        deps = dependency.Graph()
+    with deps.batch():
+        for version, parent in gaps:
+            doc_number = version.identifier
+            deps.add(tree_dir / doc_number, tree_dir / parent.identifier)
+            deps.add(tree_dir / doc_number, entry.Notice(doc_number))
+            deps.add(tree_dir / doc_number, version_dir / doc_number)
     return deps
 
 
@@ -39,39 +41,95 @@ def is_derived(version_id, deps, tree_dir):
     return notice in deps.dependencies(tree)
 
 
-def process(tree_path, previous, version_id):
-    """Build and write a tree by combining the preceding tree with changes
-    present in the associated rule"""
-    prev_tree = (tree_path / previous).read()
+def compile_version(prev_tree, version_id):
+    """Combine the preceding tree with changes present in the associated
+    rule. The preceding tree isn't modified"""
     notice = entry.Notice(version_id).read()
     notice_changes = defaultdict(list)
     for amendment in notice.amendments:
         for label, change_list in amendment.get('changes', []):
             notice_changes[label].extend(change_list)
-    new_tree = compile_regulation(prev_tree, notice_changes)
-    (tree_path / version_id).write(new_tree)
+    return compile_regulation(prev_tree, notice_changes)
+
+
+def process(tree_path, previous, version_id):
+    """Build and write a tree by combining the preceding tree with changes
+    present in the associated rule"""
+    prev_tree = (tree_path / previous).read()
+    (tree_path / version_id).write(compile_version(prev_tree, version_id))
+
+
+def process_chain(deps, tree_dir, versions_with_parents):
+    """Build all of the stale, derived trees in version order. Rather than
+    reading each tree back as the parent of the next, keep the most recently
+    built parent in memory (compilation shares unchanged nodes, so this is
+    cheap). Each tree is written as soon as it's built, so that trees needn't
+    accumulate in memory and aren't lost if a later one fails. Staleness is
+    only calculated once, up front: building a tree can only make trees
+    which derive from it stale, and those are already marked as such.
+    Returns the ids of the versions built"""
+    parent_ids = set(parent.identifier
+                     for _, parent in versions_with_parents if parent)
+    built_parent, built = {}, []
+    for version, parent in versions_with_parents:
+        version_id = version.identifier
+        tree_entry = tree_dir / version_id
+        if not is_derived(version_id, deps, tree_dir) or \
+                not deps.is_stale(tree_entry):
+            continue
+        deps.validate_for(tree_entry, pending=[
+            tree_dir / parent_id for parent_id in built_parent])
+        logger.debug("Building %s", tree_entry)
+        prev_tree = built_parent.get(parent.identifier)
+        if prev_tree is None:
+            prev_tree = (tree_dir / parent.identifier).read()
+        new_tree = compile_version(prev_tree, version_id)
+        tree_entry.write(new_tree)
+        built.append(version_id)
+        # Parents only move forward, so older ones won't be needed again
+        if version_id in parent_ids:
+            built_parent = {version_id: new_tree}
+    return built
+
+
+def _versions_with_parents(cfr_title, cfr_part):
+    versions = [c.read()
+                for c in entry.Version(cfr_title, cfr_part).sub_entries()]
+    return list(zip(versions, Version.parents_of(versions)))
+
+
+def builders(deps, cfr_title, cfr_part):
+    """Add dependencies for the trees which must be derived from rules,
+    returning how to build each. See `executor.build_stale`"""
+    tree_dir = entry.Tree(cfr_title, cfr_part)
+    version_dir = entry.Version(cfr_title, cfr_part)
+
+    versions_with_parents = _versions_with_parents(cfr_title, cfr_part)
+    dependencies(tree_dir, version_dir, versions_with_parents, deps)
+
+    return {tree_dir / version.identifier:
+            (process, (tree_dir, parent.identifier, version.identifier))
+            for version, parent in versions_with_parents
+            if is_derived(version.identifier, deps, tree_dir)}
 
 
 @click.command()
 @click.argument('cfr_title', type=int)
 @click.argument('cfr_part', type=int)
-def fill_with_rules(cfr_title, cfr_part):
+@click.option('--chain/--no-chain', default=True,
+              help="Keep each tree in memory as the parent of the next, "
+                   "rather than reading it back from the index")
+def fill_with_rules(cfr_title, cfr_part, chain):
     """Fill in missing trees using data from rules. When a regulation tree
     cannot be derived through annual editions, it must be built by parsing the
     changes in final rules. This command builds those missing trees"""
     logger.info("Fill with rules - %s CFR %s", cfr_title, cfr_part)
-    tree_dir = entry.Tree(cfr_title, cfr_part)
-    version_dir = entry.Version(cfr_title, cfr_part)
-
-    versions = [c.read() for c in version_dir.sub_entries()]
-    versions_with_parents = list(zip(versions, Version.parents_of(versions)))
-    deps = dependencies(tree_dir, version_dir, versions_with_parents)
-
-    derived = [(version.identifier, parent.identifier)
-               for version, parent in versions_with_parents
-               if is_derived(version.identifier, deps, tree_dir)]
-    for version_id, parent_id in derived:
-        deps.validate_for(tree_dir / version_id)
-        if deps.is_stale(tree_dir / version_id):
-            process(tree_dir, parent_id, version_id)
-            deps.rebuild()
+    deps = dependency.Graph()
+    if chain:
+        tree_dir = entry.Tree(cfr_title, cfr_part)
+        versions_with_parents = _versions_with_parents(cfr_title, cfr_part)
+        dependencies(tree_dir, entry.Version(cfr_title, cfr_part),
+                     versions_with_parents, deps)
+        process_chain(deps, tree_dir, versions_with_parents)
+    else:
+        executor.build_stale(deps, builders(deps, cfr_title, cfr_part))
@@ -2,7 +2,7 @@ import click
 import logging
 
 from regparser.commands import utils
-from regparser.index import dependency, entry
+from regparser.index import dependency, entry, executor
 from regparser.plugins import classes_by_shorthand
 import settings
 
@@ -17,17 +17,24 @@ for doc_type in LAYER_CLASSES:
 logger = logging.getLogger(__name__)
 
 
+def add_dependencies(deps, doc_entry, doc_type):
+    """Tie each of the layers for this document to its source"""
+    layer_dir = entry.Layer(doc_type, *doc_entry.path)
+    with deps.batch():
+        for layer_name in LAYER_CLASSES[doc_type]:
+            # Layers depend on their associated tree
+            deps.add(layer_dir / layer_name, doc_entry)
+        if doc_type == 'cfr':
+            # Meta layer also depends on the version info
+            deps.add(layer_dir / 'meta', entry.Version(*doc_entry.path))
+
+
 def stale_layers(doc_entry, doc_type):
     """Return the name of layer dependencies which are now stale. Limit to a
     particular doc_type"""
     deps = dependency.Graph()
     layer_dir = entry.Layer(doc_type, *doc_entry.path)
-    for layer_name in LAYER_CLASSES[doc_type]:
-        # Layers depend on their associated tree
-        deps.add(layer_dir / layer_name, doc_entry)
-    if doc_type == 'cfr':
-        # Meta layer also depends on the version info
-        deps.add(layer_dir / 'meta', entry.Version(*doc_entry.path))
+    add_dependencies(deps, doc_entry, doc_type)
 
     for layer_name in LAYER_CLASSES[doc_type]:
         layer_entry = layer_dir / layer_name
@@ -42,10 +49,11 @@ def process_cfr_layers(stale_names, cfr_title, version_entry):
     tree = entry.Tree(*version_entry.path).read()
     version = version_entry.read()
     layer_dir = entry.Layer.cfr(*version_entry.path)
-    for layer_name in stale_names:
-        layer_json = LAYER_CLASSES['cfr'][layer_name](
-            tree, cfr_title=int(cfr_title), version=version).build()
-        (layer_dir / layer_name).write(layer_json)
+    with entry.bulk_writer():
+        for layer_name in stale_names:
+            layer_json = LAYER_CLASSES['cfr'][layer_name](
+                tree, cfr_title=int(cfr_title), version=version).build()
+            (layer_dir / layer_name).write(layer_json)
 
 
 def process_preamble_layers(stale_names, preamble_entry):
@@ -53,9 +61,33 @@ def process_preamble_layers(stale_names, preamble_entry):
     index. Assumes all dependencies have already been checked"""
     tree = preamble_entry.read()
     layer_dir = entry.Layer.preamble(*preamble_entry.path)
-    for layer_name in stale_names:
-        layer_json = LAYER_CLASSES['preamble'][layer_name](tree).build()
-        (layer_dir / layer_name).write(layer_json)
+    with entry.bulk_writer():
+        for layer_name in stale_names:
+            layer_json = LAYER_CLASSES['preamble'][layer_name](tree).build()
+            (layer_dir / layer_name).write(layer_json)
+
+
+def _build_cfr_layers(layer_entries, cfr_title, version_entry):
+    """Adapts `process_cfr_layers` to `executor.Batch`"""
+    process_cfr_layers([layer_entry.path[-1] for layer_entry in layer_entries],
+                       cfr_title, version_entry)
+
+
+def cfr_builders(deps, tree_entries):
+    """Add dependencies for the layers of each of these trees (which need not
+    exist yet), returning how to build each layer. See
+    `executor.build_stale`; each tree's layers are built together, so the
+    tree is only read once"""
+    result = {}
+    for tree_entry in tree_entries:
+        add_dependencies(deps, tree_entry, 'cfr')
+        tree_title = tree_entry.path[0]
+        version_entry = entry.Version(*tree_entry.path)
+        layer_dir = entry.Layer.cfr(*tree_entry.path)
+        batch = executor.Batch(_build_cfr_layers, (tree_title, version_entry))
+        for layer_name in LAYER_CLASSES['cfr']:
+            result[layer_dir / layer_name] = batch
+    return result
 
 
 @click.command()
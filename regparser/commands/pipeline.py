@@ -1,12 +1,41 @@
+from collections import OrderedDict
+
 import click
 
 from regparser.commands.annual_editions import annual_editions
 from regparser.commands.current_version import current_version
-from regparser.commands.diffs import diffs
-from regparser.commands.fill_with_rules import fill_with_rules
-from regparser.commands.layers import layers
+from regparser.commands.diffs import (
+    builders as diff_builders, diffs, PAIRS)
+from regparser.commands.fill_with_rules import (
+    builders as rule_builders, fill_with_rules)
+from regparser.commands.layers import cfr_builders as layer_builders, layers
 from regparser.commands.versions import versions
 from regparser.commands.write_to import write_to
+from regparser.index import dependency, entry, executor
+
+
+def build_in_parallel(cfr_title, cfr_part, jobs, fill_gaps,
+                      diff_pairs=('all',)):
+    """Rather than deriving trees from rules, then building layers, then
+    diffs, treat them all as one set of targets within the dependency graph.
+    Independent targets are built in parallel; layers and diffs for a tree
+    can start as soon as that tree has been written"""
+    deps = dependency.Graph()
+    # Trees first, so they're started as soon as possible
+    builders = OrderedDict()
+    tree_dir = entry.Tree(cfr_title, cfr_part)
+    version_ids = set(tree.path[-1] for tree in tree_dir.sub_entries())
+    if fill_gaps:
+        tree_builders = rule_builders(deps, cfr_title, cfr_part)
+        version_ids.update(tree.path[-1] for tree in tree_builders)
+        builders.update(tree_builders)
+    version_ids = sorted(version_ids)
+
+    builders.update(layer_builders(
+        deps, [tree_dir / version_id for version_id in version_ids]))
+    builders.update(diff_builders(deps, cfr_title, cfr_part, version_ids,
+                                  diff_pairs))
+    executor.build_stale(deps, builders, jobs)
 
 
 @click.command()
@@ -15,8 +44,15 @@ from regparser.commands.write_to import write_to
 @click.argument('output', envvar='EREGS_OUTPUT_DIR')
 @click.option('--only-latest', is_flag=True, default=False,
               help="Don't derive history; use the latest annual edition")
+@click.option('--jobs', type=int, default=1,
+              help="Number of processes used to build trees, layers and "
+                   "diffs")
+@click.option('--diff-pairs', type=click.Choice(PAIRS), multiple=True,
+              default=['all'],
+              help="Which pairs of versions to diff; may be repeated")
 @click.pass_context
-def pipeline(ctx, cfr_title, cfr_part, output, only_latest):
+def pipeline(ctx, cfr_title, cfr_part, output, only_latest, jobs,
+             diff_pairs):
     """Full regulation parsing pipeline. Consists of retrieving and parsing
     annual edition, attempting to parse final rules in between, deriving
     layers and diffs, and writing them to disk or an API
@@ -33,7 +69,15 @@ def pipeline(ctx, cfr_title, cfr_part, output, only_latest):
     else:
         ctx.invoke(versions, **params)
         ctx.invoke(annual_editions, **params)
-        ctx.invoke(fill_with_rules, **params)
-    ctx.invoke(layers, **params)
-    ctx.invoke(diffs, **params)
-    ctx.invoke(write_to, output=output, **params)
+    if jobs > 1:
+        build_in_parallel(cfr_title, cfr_part, jobs,
+                          fill_gaps=not only_latest, diff_pairs=diff_pairs)
+    else:
+        if not only_latest:
+            ctx.invoke(fill_with_rules, **params)
+        ctx.invoke(layers, **params)
+        ctx.invoke(diffs, pairs=diff_pairs, **params)
+    # Diffs between other pairs of versions must be computed as they're
+    # written
+    ctx.invoke(write_to, output=output,
+               compute_diffs=set(diff_pairs) != {'all'}, **params)
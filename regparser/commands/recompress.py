@@ -0,0 +1,48 @@
+import hashlib
+import logging
+
+import click
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from regparser.index import compression, storage
+from regparser.web.index.models import Blob
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option('--codec', type=click.Choice(sorted(compression.CODECS)),
+              help="Defaults to the EREGS_INDEX_CODEC setting")
+@click.option('--storage', 'backend', type=click.Choice(storage.BACKENDS),
+              help="Defaults to the EREGS_INDEX_STORAGE setting")
+def recompress(codec, backend):
+    """Re-encode existing index contents with a different compression codec,
+    moving them to a different storage backend if requested. Entries aren't
+    modified, so nothing is marked as stale."""
+    if codec is None:
+        codec = settings.EREGS_INDEX_CODEC
+    if backend is None:
+        backend = settings.EREGS_INDEX_STORAGE
+
+    digests = list(Blob.objects.filter(~Q(codec=codec) | ~Q(storage=backend))
+                   .values_list('digest', flat=True))
+    logger.info("Recompressing %s blobs with %r, stored in %s",
+                len(digests), codec, backend)
+    for digest in digests:
+        with transaction.atomic():
+            blobs = Blob.objects.filter(digest=digest)
+            fields = blobs.values_list(
+                'digest', 'contents', 'codec', 'storage').get()
+            contents = bytes(storage.read(*fields))
+            # Never replace (and delete) the only copy with anything else
+            if hashlib.sha256(contents).hexdigest() != digest:
+                raise click.ClickException(
+                    "Contents of blob {} don't match its digest".format(
+                        digest))
+            blobs.update(**storage.blob_fields(digest, contents, codec,
+                                               backend))
+        _, _, old_codec, old_backend = fields
+        if (old_codec, old_backend) != (codec, backend):
+            storage.delete(digest, old_codec, old_backend)
@@ -44,10 +44,13 @@ def sxs_layers(cfr_title, cfr_part):
     tree_dir = entry.Tree(cfr_title, cfr_part)
     for version_id in tree_dir:
         if is_stale(cfr_title, cfr_part, version_id):
-            tree = (tree_dir / version_id).read()
             notices = [sxs.read() for sxs in previous_sxs(
                         cfr_title, cfr_part, version_id)]
-            layer_json = SectionBySection(tree, notices).build()
+            layer = SectionBySection(None, notices)
+            # Only the nodes which analyses refer to are needed
+            subtrees = (tree_dir / version_id).read_lazy(
+                layer.referenced_labels())
+            layer_json = layer.build_for(subtrees.values())
             entry.Layer.cfr(
                 cfr_title, cfr_part, version_id, 'analyses').write(
                 layer_json)
@@ -3,10 +3,13 @@ def relevant_paths(root_dir, only_title, only_part):
     particular cfr title/part. Most index entries encode this as their first
     two path components"""
     prefix_path = root_dir.path
+    # Narrow the search in the index where we can
+    if only_title:
+        root_dir = root_dir / only_title
+        if only_part:
+            root_dir = root_dir / only_part
     for sub_entry in root_dir.sub_entries():
         suffix_path = sub_entry.path[len(prefix_path):]
-        if only_title and suffix_path[0] != str(only_title):
-            continue
         if only_part and suffix_path[1] != str(only_part):
             continue
         yield sub_entry
@@ -1,10 +1,12 @@
+from collections import defaultdict
 import click
 import logging
 
 from regparser.api_writer import Client
 from regparser.commands import utils
+from regparser.commands.diffs import builders as diff_builders, diff_between
 from regparser.history.versions import Version
-from regparser.index import entry
+from regparser.index import dependency, entry
 from regparser.notice.build import add_footnotes, process_sxs
 
 
@@ -26,17 +28,17 @@ def write_layers(client, only_title, only_part):
     for layer_entry in utils.relevant_paths(entry.Layer.cfr(), only_title,
                                             only_part):
         _, cfr_title, cfr_part, version_id, layer_name = layer_entry.path
-        layer = layer_entry.read()
         doc_id = version_id + '/' + cfr_part
-        client.layer(layer_name, 'cfr', doc_id).write(layer)
+        client.layer(layer_name, 'cfr', doc_id).write_stream(
+            layer_entry.read_stream())
 
     if only_title is None and only_part is None:
         for sub_entry in entry.Layer().sub_entries():
             if sub_entry.path[0] == 'cfr':
                 continue
             doc_type, doc_id, layer_name = sub_entry.path
-            layer = sub_entry.read()
-            client.layer(layer_name, doc_type, doc_id).write(layer)
+            client.layer(layer_name, doc_type, doc_id).write_stream(
+                sub_entry.read_stream())
 
 
 def transform_notice(notice_xml):
@@ -77,12 +79,35 @@ def write_notices(client, only_title, only_part):
                 transform_notice(notice_xml))
 
 
-def write_diffs(client, only_title, only_part):
-    for diff_entry in utils.relevant_paths(entry.Diff(), only_title,
+def write_diffs(client, only_title, only_part, compute_missing=False):
+    """Write the diffs in the index. If `compute_missing` is set, write the
+    diffs between every pair of versions with trees, computing any which
+    weren't precomputed"""
+    if not compute_missing:
+        for diff_entry in utils.relevant_paths(entry.Diff(), only_title,
+                                               only_part):
+            cfr_title, cfr_part, lhs_id, rhs_id = diff_entry.path
+            client.diff(cfr_part, lhs_id, rhs_id).write_stream(
+                diff_entry.read_stream())
+        return
+
+    version_ids = defaultdict(list)
+    for tree_entry in utils.relevant_paths(entry.Tree(), only_title,
                                            only_part):
-        cfr_title, cfr_part, lhs_id, rhs_id = diff_entry.path
-        diff = diff_entry.read()
-        client.diff(cfr_part, lhs_id, rhs_id).write(diff)
+        cfr_title, cfr_part, version_id = tree_entry.path
+        version_ids[(cfr_title, cfr_part)].append(version_id)
+
+    deps = dependency.Graph()
+    for (cfr_title, cfr_part), part_version_ids in sorted(version_ids.items()):
+        # Register all of the dependencies at once
+        pairs = [path.path[-2:] for path in diff_builders(
+            deps, cfr_title, cfr_part, part_version_ids)]
+        trees = {}
+        with entry.bulk_writer():
+            for lhs_id, rhs_id in sorted(pairs):
+                diff = diff_between(cfr_title, cfr_part, lhs_id, rhs_id,
+                                    deps, trees)
+                client.diff(cfr_part, lhs_id, rhs_id).write(diff)
 
 
 def write_preambles(client):
@@ -95,7 +120,10 @@ def write_preambles(client):
 @click.argument('output', envvar='EREGS_OUTPUT_DIR')
 @click.option('--cfr_title', type=int, help="Limit to one CFR title")
 @click.option('--cfr_part', type=int, help="Limit to one CFR part")
-def write_to(output, cfr_title, cfr_part):
+@click.option('--compute-diffs', is_flag=True, default=False,
+              help="Compute any diffs between versions which haven't been "
+                   "built (see the diffs command's --pairs)")
+def write_to(output, cfr_title, cfr_part, compute_diffs):
     """Export data. Sends all data in the index to an external source.
 
     \b
@@ -113,4 +141,4 @@ def write_to(output, cfr_title, cfr_part):
     # Note that layers must always be written _after_ the trees they reference
     write_layers(client, cfr_title, cfr_part)
     write_notices(client, cfr_title, cfr_part)
-    write_diffs(client, cfr_title, cfr_part)
+    write_diffs(client, cfr_title, cfr_part, compute_diffs)
@@ -0,0 +1,43 @@
+"""Codecs for compressing the contents of index entries. Each is referenced
+by name, which is stored alongside the compressed contents so that entries
+can always be decompressed, regardless of current settings"""
+from collections import namedtuple
+import zlib
+
+try:
+    import lzma
+except ImportError:     # Python 2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+Codec = namedtuple('Codec', ['compress', 'decompress'])
+
+
+def _identity(content):
+    return content
+
+
+CODECS = {
+    '': Codec(_identity, _identity),
+    'zlib': Codec(zlib.compress, zlib.decompress),
+}
+if lzma:
+    CODECS['lzma'] = Codec(lzma.compress, lzma.decompress)
+if zstandard:
+    CODECS['zstd'] = Codec(
+        lambda content: zstandard.ZstdCompressor().compress(content),
+        lambda content: zstandard.ZstdDecompressor().decompress(content))
+
+
+def codec(name):
+    """Look up a codec by name, raising a descriptive error if it's not
+    available"""
+    if name not in CODECS:
+        raise ValueError("Unknown or unavailable codec: {}. Options: {}"
+                         .format(name, ', '.join(sorted(CODECS))))
+    return CODECS[name]
@@ -1,5 +1,7 @@
+from contextlib import contextmanager
 import logging
 
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 import networkx
@@ -9,6 +11,8 @@ from regparser.web.index.models import (
 
 
 logger = logging.getLogger(__name__)
+# Keep "IN" clauses below SQLite's limit on query parameters
+QUERY_CHUNK_SIZE = 500
 
 
 class Missing(Exception):
@@ -27,38 +31,84 @@ class Graph(object):
     updated"""
 
     def __init__(self):
+        self._added_edges = set()
+        self._removed_edges = set()
+        self._batch_depth = 0
+        self._needs_rebuild = True
+        self._changed_nodes = set()
         self.deserialize()
-        self.rebuild()
 
     @transaction.atomic
     def serialize(self):
-        """Convert the in-memory self._graph into db records"""
-        Dependency.objects.all().delete()
+        """Write any edges added or removed since the last call (see `add`
+        and `clear_for`) into db records. Unchanged edges aren't touched"""
+        for depender, target in self._removed_edges:
+            Dependency.objects.filter(
+                depender_id=depender, target_id=target).delete()
 
-        new_vertices = set(self._graph.nodes()) - set(
-            node.label for node in DependencyNode.objects.all())
-        DependencyNode.objects.bulk_create(
-            DependencyNode(label=label) for label in new_vertices)
+        labels = list(set(
+            label for edge in self._added_edges for label in edge))
+        for idx in range(0, len(labels), QUERY_CHUNK_SIZE):
+            chunk = labels[idx:idx + QUERY_CHUNK_SIZE]
+            existing = set(DependencyNode.objects.filter(
+                label__in=chunk).values_list('label', flat=True))
+            DependencyNode.objects.bulk_create(
+                DependencyNode(label=label) for label in chunk
+                if label not in existing)
 
         Dependency.objects.bulk_create(
             Dependency(depender_id=depender, target_id=target)
-            for (depender, target) in self._graph.edges())
+            for (depender, target) in self._added_edges)
+
+        self._added_edges.clear()
+        self._removed_edges.clear()
 
     @transaction.atomic
     def deserialize(self):
         """Convert db records into the in-memory self._graph"""
         self._graph = networkx.DiGraph()
+        self._scanned = False
         self._graph.add_nodes_from(
             n.label for n in DependencyNode.objects.all())
         self._graph.add_edges_from(
             (e.depender_id, e.target_id)
             for e in Dependency.objects.all())
 
+    @contextmanager
+    def batch(self):
+        """Defer writing changes to the db until the end of the block. Useful
+        when adding many dependencies at once:
+            with deps.batch():
+                for ...:
+                    deps.add(...)"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.serialize()
+
+    def _changed(self, key):
+        """The dependencies of `key` have been modified; staleness info will
+        need to be recalculated and, unless we're in the middle of a batch,
+        the changes saved"""
+        self._changed_nodes.add(key)
+        self._needs_rebuild = True
+        if not self._batch_depth:
+            self.serialize()
+
     def add(self, output_entry, input_entry):
         """Add a dependency where output tuple relies on input_tuple"""
-        self._graph.add_edge(str(input_entry), str(output_entry))
-        self.rebuild()
-        self.serialize()    # @todo: make this incremental
+        edge = (str(input_entry), str(output_entry))
+        if self._graph.has_edge(*edge):
+            return
+        self._graph.add_edge(*edge)
+        if edge in self._removed_edges:
+            self._removed_edges.remove(edge)
+        else:
+            self._added_edges.add(edge)
+        self._changed(edge[1])
 
     def __contains__(self, key):
         """Does the graph contain a particular node?"""
@@ -80,46 +130,134 @@ class Graph(object):
         else:
             return []
 
-    def rebuild(self):
+    def upstream(self, filename):
+        """What other nodes does this filename depend on, directly or
+        indirectly?"""
+        filename = str(filename)
+        if filename in self._graph:
+            return networkx.ancestors(self._graph, filename)
+        else:
+            return set()
+
+    def _downstream_of(self, nodes):
+        """Set of the provided nodes and all nodes which depend on them,
+        directly or indirectly"""
+        to_visit, seen = list(nodes), set(nodes)
+        while to_visit:
+            for successor in self._graph.successors(to_visit.pop()):
+                if successor not in seen:
+                    seen.add(successor)
+                    to_visit.append(successor)
+        return seen
+
+    def _modification_times(self, labels=None):
+        """Retrieve (modified, content_changed) dicts for the requested
+        labels (all entries, in a single query, if None)"""
+        query = DBEntry.objects.values_list('label_id', 'modified', 'changed')
+        if labels is None:
+            rows = query
+        else:
+            labels = list(labels)
+            rows = (row for idx in range(0, len(labels), QUERY_CHUNK_SIZE)
+                    for row in query.filter(
+                        label_id__in=labels[idx:idx + QUERY_CHUNK_SIZE]))
+
+        modified, content_changed = {}, {}
+        for label, modtime, changed in rows:
+            modified[label] = modtime
+            if settings.EREGS_DIGEST_STALENESS and changed:
+                content_changed[label] = changed
+            else:
+                content_changed[label] = modtime
+        return modified, content_changed
+
+    def rebuild(self, labels=None):
         """Scan the modification times of all the nodes in the graph to
         determine what's been updated. We mark nodes "stale" if one of their
         dependencies has been updated since the depending node was built. Use
-        topological sort to make sure we process dependencies first."""
-        for node in networkx.topological_sort(self._graph):
-            entry = DBEntry.objects.filter(label_id=node).first()
-            if entry:
-                modtime = entry.modified
+        topological sort to make sure we process dependencies first.
+
+        Modification times are retrieved in a single query. Only nodes which
+        have changed since the last rebuild (and those downstream of them) are
+        sorted and recalculated. If the caller knows which entries have been
+        written (e.g. it just built them), it can pass them as `labels`; only
+        those (and their dependers) are then checked, skipping the scan. The
+        first rebuild always scans everything.
+
+        If settings.EREGS_DIGEST_STALENESS is set, a dependency only counts
+        as updated when its contents have changed, so rewriting an entry with
+        identical contents won't cause everything downstream to be rebuilt"""
+        self._needs_rebuild = False
+        changed = self._changed_nodes
+        self._changed_nodes = set()
+        if labels is None or not self._scanned:
+            labels = None
+            self._scanned = True
+            modified, content_changed = self._modification_times()
+            for node, attrs in self._graph.nodes_iter(data=True):
+                if 'stale' not in attrs or \
+                        attrs['modified'] != modified.get(node):
+                    changed.add(node)
+        else:
+            changed.update(str(label) for label in labels)
+        changed &= set(self._graph.nodes_iter())
+        to_update = self._downstream_of(changed)
+        if labels is not None:
+            modified, content_changed = self._modification_times(to_update)
+        now = timezone.now()
+
+        # Only the changed region needs sorting; nodes outside of it were
+        # calculated by a previous rebuild
+        for node in networkx.topological_sort(
+                self._graph.subgraph(to_update)):
+            if node in modified:
+                modtime = modified[node]
+                changed = content_changed[node]
                 stale = ''
             else:
-                modtime = timezone.now()
+                modtime = changed = now
                 stale = node
 
             # Check immediate dependencies (which were updated in a previous
             # step)
             for dependency in self.dependencies(node):
-                if self.node(dependency)['modtime'] > modtime:
+                if self.node(dependency)['changed'] > modtime:
                     stale = dependency
                 else:
                     stale = self.node(dependency)['stale'] or stale
 
-            self.node(node).update(modtime=modtime, stale=stale)
+            self.node(node).update(modtime=modtime, changed=changed,
+                                   stale=stale, modified=modified.get(node))
 
-    def validate_for(self, entry):
-        """Raise an exception if a particular output has stale dependencies"""
+    def validate_for(self, entry, pending=()):
+        """Raise an exception if a particular output has stale dependencies.
+        Dependencies in `pending` are ignored, as the caller is about to
+        build them"""
         key = str(entry)
         logger.debug("Validating dependencies for %r", key)
+        if self._needs_rebuild:
+            self.rebuild()
+        pending = set(str(dependency) for dependency in pending)
         for dependency in self.dependencies(key):
+            if dependency in pending:
+                continue
             if self.node(dependency).get('stale'):
                 raise Missing(key, self.node(dependency)['stale'])
 
     def is_stale(self, entry):
         """Determine if a file needs to be rebuilt"""
+        if self._needs_rebuild:
+            self.rebuild()
         return bool(self.node(str(entry)).get('stale'))
 
     def clear_for(self, entry):
         """Remove all dependencies for a particular entry"""
         key = str(entry)
-        for dependency in self.dependencies(key):
-            return self._graph.remove_edge(dependency, key)
-        self.rebuild()
-        self.serialize()    # @todo: incremental
+        for dependency in list(self.dependencies(key)):
+            self._graph.remove_edge(dependency, key)
+            edge = (dependency, key)
+            if edge in self._added_edges:
+                self._added_edges.remove(edge)
+            else:
+                self._removed_edges.add(edge)
+        self._changed(key)
@@ -1,25 +1,81 @@
+import codecs
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import io
 import json
 import logging
 import os
 
 from django.conf import settings
+from django.db import connection, IntegrityError, transaction
+from django.utils import timezone
 from lxml import etree
 
 from regparser.history.versions import Version as VersionStruct
+from regparser.index import storage
 from regparser.notice.encoder import AmendmentEncoder
 from regparser.notice.xml import NoticeXML
+from regparser.tree import packed
 from regparser.tree.struct import (
-    frozen_node_decode_hook, full_node_decode_hook, FullNodeEncoder)
+    frozen_node_decode_hook, full_node_decode_hook, FullNodeEncoder,
+    iter_nodes)
 from regparser.tree.xml_parser.xml_wrapper import XMLWrapper
-from regparser.web.index.models import DependencyNode, Entry as DBEntry
+from regparser.web.index.models import (
+    Blob, DependencyNode, Entry as DBEntry, Version as DBVersion)
 
 logger = logging.getLogger(__name__)
+# Number of buffered writes (see `bulk_writer`) to hold before flushing; also
+# keeps "IN" clauses below SQLite's limit on query parameters
+BULK_WRITE_SIZE = 200
+# Stack of the write buffers for any active `bulk_writer`s
+_write_buffers = []
+
+
+class ReadCache(object):
+    """Least-recently-used cache of entries (see `Entry.IMMUTABLE`), bounded
+    by the EREGS_INDEX_CACHE_SIZE setting. Values are only valid for the
+    modification time they were read at, so writes from other processes are
+    noticed"""
+    def __init__(self):
+        self._values = OrderedDict()    # label -> (modified, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, label, modified):
+        """Return the cached value, or None if not present or outdated"""
+        modified_and_value = self._values.pop(label, None)
+        if modified_and_value and modified_and_value[0] == modified:
+            self._values[label] = modified_and_value   # most recently used
+            self.hits += 1
+            return modified_and_value[1]
+        self.misses += 1
+
+    def put(self, label, modified, value):
+        self._values[label] = (modified, value)
+        while len(self._values) > settings.EREGS_INDEX_CACHE_SIZE:
+            self._values.popitem(last=False)
+
+    def invalidate(self, label):
+        self._values.pop(label, None)
+
+    def clear(self):
+        self._values.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+read_cache = ReadCache()
 
 
 class Entry(object):
     """Encapsulates an entry within the index. This could be a directory or a
     file"""
     PREFIX = None
+    # Deserialized values can be shared between reads, so are what we cache.
+    # Otherwise, the cache holds the (decompressed) contents; copying values
+    # would cost more than deserializing them again
+    IMMUTABLE = True
 
     def __init__(self, *args):
         self.path = tuple(str(arg) for arg in args)
@@ -38,31 +94,103 @@ class Entry(object):
         return os.path.join(prefix, *self.path)
 
     def write(self, content):
-        dep, _ = DependencyNode.objects.update_or_create(label=str(self))
-        DBEntry.objects.update_or_create(label=dep, defaults={
-            'contents': self.serialize(content)})
+        contents = self.serialize(content)
+        read_cache.invalidate(str(self))
+        if _write_buffers:
+            _write_buffers[-1].append((self, contents, content))
+            if len(_write_buffers[-1]) >= BULK_WRITE_SIZE:
+                _flush(_write_buffers[-1])
+            return
+        digest = hashlib.sha256(contents).hexdigest()
+        now = timezone.now()
+        dep, _ = DependencyNode.objects.get_or_create(label=str(self))
+        entries = DBEntry.objects.filter(label=dep)
+        # If the contents haven't changed, we only need to note that the
+        # entry's been rebuilt
+        if not entries.filter(blob=digest).update(modified=now):
+            # Identical contents are stored only once
+            if not Blob.objects.filter(digest=digest).exists():
+                Blob.objects.get_or_create(
+                    digest=digest,
+                    defaults=storage.blob_fields(digest, contents))
+            if not entries.update(blob=digest, modified=now, changed=now):
+                DBEntry.objects.create(label=dep, blob_id=digest,
+                                       changed=now)
+        self._write_metadata(content)
         logger.info("Wrote {}".format(str(self)))
 
+    def _write_metadata(self, content):
+        """Hook for storing additional information about the content once
+        the entry's been written"""
+        pass
+
     def serialize(self, content):
         """Default implementation; treat content as bytes"""
         return content
 
+    def _contents(self):
+        """Stored contents, decompressed. Depending on the storage, database
+        and codec, this may be a buffer rather than bytes; we avoid copying it
+        where we can"""
+        fields = DBEntry.objects.values_list(
+            'blob', 'blob__contents', 'blob__codec', 'blob__storage'
+        ).get(label=str(self))
+        return storage.read(*fields)
+
     def read(self):
-        buffered_contents = DBEntry.objects.get(label=str(self)).contents
-        # load it all into memory -- @todo optimization point
-        return self.deserialize(bytes(buffered_contents))
+        if not settings.EREGS_INDEX_CACHE_SIZE:
+            return self.deserialize(self._contents())
+
+        label = str(self)
+        modified = DBEntry.objects.values_list(
+            'modified', flat=True).get(label=label)
+        cached = read_cache.get(label, modified)
+        if cached is None:
+            cached = self._contents()
+            if self.IMMUTABLE:
+                cached = self.deserialize(cached)
+            read_cache.put(label, modified, cached)
+        if self.IMMUTABLE:
+            return cached
+        return self.deserialize(cached)
+
+    def read_stream(self):
+        """File-like access to the serialized contents, for consumers which
+        only need to forward them"""
+        contents = self._contents()
+        try:
+            return _BufferReader(contents)
+        except TypeError:   # Python 2's buffers can't be viewed
+            return io.BytesIO(_as_bytes(contents))
 
     def deserialize(self, content):
         """Default implementation; treat the content as bytes"""
-        return content
+        return _as_bytes(content)
+
+    def _beneath(self, lookup):
+        """Query filter for labels which are beneath this entry. `lookup`
+        leads to the label's text, through foreign keys which hold the same
+        value. On SQLite, which compares labels by codepoint, the matching
+        labels are exactly those in the range [prefix, upper_bound); unlike
+        "startswith", this can use the index of the first key. Other
+        databases may use a locale's collation (which ignores punctuation,
+        such as the separator), so use "startswith" there"""
+        prefix = str(self) + os.sep
+        if connection.vendor != 'sqlite':
+            return {lookup + '__startswith': prefix}
+        field = lookup.split('__')[0]
+        upper_bound = prefix[:-1] + chr(ord(os.sep) + 1)
+        return {field + '__gte': prefix, field + '__lt': upper_bound}
 
     def sub_entries(self):
-        # @todo optimization point: use db indexes/similar to speed up this
-        # query
+        """All entries beneath this one, ordered by label"""
         prefix = str(self) + os.sep
-        for entry in DBEntry.objects.filter(label__label__startswith=prefix):
-            # Note: implicitly ordering by label in the DB model
-            suffix = entry.label_id[len(prefix):]
+        # Only retrieve the labels, not the contents
+        labels = DBEntry.objects.filter(
+            **self._beneath('label__label')
+        ).order_by('label').values_list('label', flat=True)
+        for label in labels:
+            suffix = label[len(prefix):]
             sub_entry = self
             for suffix_part in suffix.split(os.sep):
                 sub_entry = sub_entry / suffix_part
@@ -72,26 +200,179 @@ class Entry(object):
         return DBEntry.objects.filter(label=str(self)).exists()
 
 
+@contextmanager
+def bulk_writer():
+    """Buffer writes to entries within this block, storing them in batches,
+    each within a single transaction. Buffered entries aren't readable until
+    the batch is flushed (at the latest, at the end of the block):
+        with bulk_writer():
+            for ...:
+                some_entry.write(...)"""
+    if _write_buffers:     # nested; the outer writer will flush
+        yield
+        return
+    buf = []
+    _write_buffers.append(buf)
+    try:
+        yield
+        _flush(buf)
+    finally:
+        _write_buffers.pop()
+
+
+@transaction.atomic
+def _flush(buf):
+    """Store a batch of buffered writes, queued as (entry, serialized
+    contents, content) triples. See `Entry.write` for the single-entry
+    equivalent"""
+    now = timezone.now()
+    # Later writes to the same label win
+    writes = {str(path): (path, contents, content)
+              for path, contents, content in buf}
+    digests = {label: hashlib.sha256(contents).hexdigest()
+               for label, (_, contents, _) in writes.items()}
+    labels = list(writes)
+
+    # Every write updates the modification time. Doing that first also means
+    # that, on SQLite, the transaction waits for the write lock rather than
+    # failing to upgrade a read lock if another process is writing
+    DBEntry.objects.filter(label__in=labels).update(modified=now)
+
+    existing_nodes = set(DependencyNode.objects.filter(
+        label__in=labels).values_list('label', flat=True))
+    _create_missing([DependencyNode(label=label) for label in labels
+                     if label not in existing_nodes])
+
+    existing_entries = dict(DBEntry.objects.filter(
+        label__in=labels).values_list('label', 'blob'))
+    unchanged = set(label for label in labels
+                    if existing_entries.get(label) == digests[label])
+
+    new_contents = {digests[label]: writes[label][1] for label in labels
+                    if label not in unchanged}
+    existing_blobs = set(Blob.objects.filter(
+        digest__in=list(new_contents)).values_list('digest', flat=True))
+    _create_missing([
+        Blob(digest=digest, **storage.blob_fields(digest, contents))
+        for digest, contents in new_contents.items()
+        if digest not in existing_blobs])
+
+    changed_by_digest = {}
+    for label in labels:
+        if label in existing_entries and label not in unchanged:
+            changed_by_digest.setdefault(digests[label], []).append(label)
+    for digest, changed in changed_by_digest.items():
+        DBEntry.objects.filter(label__in=changed).update(
+            blob=digest, changed=now)
+    DBEntry.objects.bulk_create(
+        DBEntry(label_id=label, blob_id=digests[label], changed=now)
+        for label in labels if label not in existing_entries)
+
+    for path, _, content in writes.values():
+        path._write_metadata(content)
+    logger.info("Wrote %s entries", len(writes))
+    del buf[:]
+
+
+def _create_missing(objs):
+    """Insert all of these (new) rows at once. If a concurrent writer has
+    inserted some of them in the meantime, fall back to inserting them one at
+    a time, skipping those already present"""
+    if not objs:
+        return
+    try:
+        with transaction.atomic():
+            objs[0].__class__.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                pass
+
+
+class _BufferReader(io.RawIOBase):
+    """Read-only stream over a buffer (bytes, a memoryview from the db, a
+    mapped file, etc.). Unlike io.BytesIO, the buffer isn't copied"""
+    def __init__(self, buf):
+        super(_BufferReader, self).__init__()
+        self._view = memoryview(buf)
+        self._pos = 0
+
+    @property
+    def len(self):
+        """Total size. Lets requests send a Content-Length rather than
+        chunking the stream"""
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._view)
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        data = self._view[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buf):
+        data = self._view[self._pos:self._pos + len(buf)]
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def _as_bytes(content):
+    """Convert a buffer from the db or storage into bytes, if it isn't
+    already. On Python 2, bytes() of a memoryview gives its repr"""
+    if isinstance(content, bytes):
+        return content
+    if isinstance(content, memoryview):
+        return content.tobytes()
+    return bytes(content)
+
+
 class Notice(Entry):
     """Processes NoticeXMLs, keyed by notice_xml"""
     PREFIX = 'notice_xml'
+    IMMUTABLE = False
 
     def serialize(self, content):
         return etree.tostring(content.xml, encoding='UTF-8')
 
     def deserialize(self, content):
-        return NoticeXML(content, str(self))
+        return NoticeXML(_as_bytes(content), str(self))
 
 
 class Annual(Entry):
     """Processes XML, keyed by annual"""
     PREFIX = 'annual'
+    IMMUTABLE = False
 
     def serialize(self, content):
         return etree.tostring(content.xml, encoding='UTF-8')
 
     def deserialize(self, content):
-        return XMLWrapper(content, str(self))
+        return XMLWrapper(_as_bytes(content), str(self))
 
 
 class Version(Entry):
@@ -102,26 +383,40 @@ class Version(Entry):
         return content.json().encode('utf-8')
 
     def deserialize(self, content):
-        return VersionStruct.from_json(content.decode('utf-8'))
+        return VersionStruct.from_json(codecs.decode(content, 'utf-8'))
+
+    def _write_metadata(self, content):
+        """Also store the version's metadata so that it can be listed
+        without deserializing"""
+        DBVersion.objects.update_or_create(entry_id=str(self), defaults={
+            'identifier': content.identifier,
+            'published': content.published,
+            'effective': content.effective})
+
+    def metadata(self):
+        """Query for the metadata of all versions beneath this entry"""
+        return DBVersion.objects.filter(
+            **self._beneath('entry__label__label'))
 
     def sub_entries(self):
         """Sort children by version"""
-        versions = [path.read()
-                    for path in super(Version, self).sub_entries()]
+        fields = self.metadata().values_list(
+            'identifier', 'published', 'effective')
+        versions = [VersionStruct(*version) for version in fields]
         for version in sorted(versions):
             yield self / version.identifier
 
 
 class FinalVersion(Version):
     """Like Version, but only list versions associated with final rules"""
-    def sub_entries(self):
-        for path in super(FinalVersion, self).sub_entries():
-            if path.read().is_final:
-                yield path
+    def metadata(self):
+        return super(FinalVersion, self).metadata().filter(
+            effective__isnull=False)
 
 
 class _JSONEntry(Entry):
     """Base class for importing/exporting JSON"""
+    IMMUTABLE = False
     JSON_ENCODER = json.JSONEncoder
     JSON_DECODER = None
 
@@ -132,20 +427,51 @@ class _JSONEntry(Entry):
         return as_text.encode('utf-8')  # as bytes
 
     def deserialize(self, content):
-        as_text = content.decode('utf-8')
+        # Decoding works directly on db buffers; no need to copy into bytes
+        as_text = codecs.decode(content, 'utf-8')
         return json.loads(as_text, object_hook=self.JSON_DECODER)
 
 
 class Tree(_JSONEntry):
-    """Processes Nodes, keyed by tree"""
+    """Processes Nodes, keyed by tree. Depending on the EREGS_TREE_FORMAT
+    setting, these are serialized as JSON or in a packed binary format"""
     PREFIX = 'tree'
     JSON_ENCODER = FullNodeEncoder
     JSON_DECODER = staticmethod(full_node_decode_hook)
+    PACKED_DECODER = staticmethod(packed.decode_full)
+
+    def serialize(self, content):
+        if settings.EREGS_TREE_FORMAT == 'packed':
+            return packed.encode(content,
+                                 digests=settings.EREGS_TREE_DIGESTS)
+        return super(Tree, self).serialize(content)
+
+    def deserialize(self, content):
+        if packed.is_packed(content):
+            return self.PACKED_DECODER(content)
+        return super(Tree, self).deserialize(content)
+
+    def read_lazy(self, label_ids):
+        """Read only the subtrees with these label ids, as Nodes which are
+        decoded as they're accessed. Returns a dictionary keyed by label id;
+        labels which aren't present are omitted. Only trees in the packed
+        format can be loaded lazily; others are read in full"""
+        content = self._contents()
+        if packed.is_packed(content):
+            return packed.decode_subtrees(content, label_ids)
+        label_ids, subtrees = set(label_ids), {}
+        for node in iter_nodes(super(Tree, self).deserialize(content)):
+            label_id = node.label_id()
+            if label_id in label_ids and label_id not in subtrees:
+                subtrees[label_id] = node
+        return subtrees
 
 
 class FrozenTree(Tree):
     """Like Tree, but decodes as FrozenNodes"""
+    IMMUTABLE = True
     JSON_DECODER = staticmethod(frozen_node_decode_hook)
+    PACKED_DECODER = staticmethod(packed.decode_frozen)
 
 
 class SxS(_JSONEntry):
@@ -0,0 +1,171 @@
+from collections import defaultdict, namedtuple, OrderedDict
+from functools import partial
+import heapq
+import logging
+import multiprocessing
+import traceback
+
+from django.db import connections
+import six
+from six.moves import queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class BuildFailed(Exception):
+    def __init__(self, key, details):
+        super(BuildFailed, self).__init__(
+            "Failed to build {}:\n{}".format(key, details))
+        self.key = key
+        self.details = details
+
+
+class Batch(namedtuple('Batch', ['fn', 'args'])):
+    """Builds several entries with a single call, for when they share
+    expensive inputs (e.g. all of the layers for a tree). Map each of the
+    entries to the same Batch; it's called as fn(stale_entries, *args) once
+    all of those entries' dependencies are ready"""
+
+
+def _build(key, fn, args):
+    """Run within a worker process. Exceptions are sent back as text as they
+    may not survive being pickled"""
+    try:
+        fn(*args)
+        return key, None
+    except Exception:
+        return key, traceback.format_exc()
+
+
+class _Workers(object):
+    """Runs builders, either in a pool of processes or (if there's only one
+    job) inline. Results are placed in self.finished"""
+    def __init__(self, jobs):
+        self.finished = queue.Queue()
+        self.running = 0
+        self.pool = None
+        if jobs > 1:
+            # Each worker will need to open its own db connection
+            connections.close_all()
+            self.pool = multiprocessing.Pool(jobs)
+
+    def start(self, key, fn, args):
+        self.running += 1
+        if self.pool:
+            kwargs = {}
+            if six.PY3:
+                # Failures outside of _build (e.g. if the arguments can't be
+                # pickled) would otherwise never be reported
+                kwargs['error_callback'] = partial(self._failed, key)
+            self.pool.apply_async(_build, (key, fn, args),
+                                  callback=self.finished.put, **kwargs)
+        else:
+            fn(*args)
+            self.finished.put((key, None))
+
+    def _failed(self, key, exception):
+        self.finished.put((key, ''.join(traceback.format_exception_only(
+            type(exception), exception))))
+
+    def wait(self):
+        """Block until at least one builder has completed. Returns all the
+        completed keys"""
+        results = [self.finished.get()]
+        while True:
+            try:
+                results.append(self.finished.get_nowait())
+            except queue.Empty:
+                break
+        self.running -= len(results)
+        for key, error in results:
+            if error:
+                raise BuildFailed(key, error)
+        return [key for key, _ in results]
+
+    def close(self, success):
+        if self.pool and success:
+            self.pool.close()
+        elif self.pool:
+            self.pool.terminate()
+        if self.pool:
+            self.pool.join()
+
+
+def build_stale(deps, builders, jobs=1):
+    """Build all of the stale entries in `builders`, a dictionary mapping
+    index entries to (fn, args) pairs; calling fn(*args) should write that
+    entry. Entries can also share a `Batch`. Entries are only checked for
+    staleness once all of the other entries they (indirectly) depend on have
+    been built. This means, for example, that layers for a tree can be built
+    as soon as that tree has been written, regardless of what else is still
+    in progress. Of the entries which are ready, those earlier in `builders`
+    are started first.
+
+    If `jobs` is greater than one, the builders are run in that many worker
+    processes, so `fn` and `args` must be picklable."""
+    # Each task builds one entry or one Batch, and is named after the label
+    # of its first entry
+    tasks = OrderedDict()   # task -> (builder, entries)
+    task_of, batches = {}, {}
+    for key, builder in builders.items():
+        label = str(key)
+        if isinstance(builder, Batch):
+            task = batches.setdefault(id(builder), label)
+        else:
+            task = label
+        tasks.setdefault(task, (builder, []))[1].append(key)
+        task_of[label] = task
+    order = {task: idx for idx, task in enumerate(tasks)}
+
+    waiting_on, dependents = {}, defaultdict(set)
+    for task, (_, keys) in tasks.items():
+        upstream = set(task_of[label] for key in keys
+                       for label in deps.upstream(key) if label in task_of)
+        upstream.discard(task)
+        waiting_on[task] = upstream
+        for dependency in upstream:
+            dependents[dependency].add(task)
+
+    ready = [(order[task], task) for task, upstream in waiting_on.items()
+             if not upstream]
+    heapq.heapify(ready)
+
+    def completed(task):
+        """Queue dependents which are now ready to be checked"""
+        for dependent in dependents[task]:
+            waiting_on[dependent].discard(task)
+            if not waiting_on[dependent]:
+                heapq.heappush(ready, (order[dependent], dependent))
+
+    workers = _Workers(jobs)
+    success = False
+    try:
+        deps.rebuild()
+        while ready or workers.running:
+            while ready:
+                _, task = heapq.heappop(ready)
+                builder, keys = tasks[task]
+                for key in keys:
+                    deps.validate_for(key, pending=keys)
+                stale = [key for key in keys if deps.is_stale(key)]
+                if not stale:
+                    completed(task)
+                    continue
+                logger.debug("Building %s", ', '.join(str(s) for s in stale))
+                if isinstance(builder, Batch):
+                    workers.start(task, builder.fn,
+                                  (stale,) + tuple(builder.args))
+                else:
+                    fn, args = builder
+                    workers.start(task, fn, args)
+            if workers.running:
+                built = workers.wait()
+                # Only the entries just written need to be checked
+                deps.rebuild([str(key) for task in built
+                              for key in tasks[task][1]])
+                for task in built:
+                    completed(task)
+        success = True
+    finally:
+        workers.close(success)
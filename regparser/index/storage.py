@@ -0,0 +1,99 @@
+"""Backends for the contents of index entries. Entry metadata (labels,
+modification times, dependencies) always lives in the database; the
+(compressed) contents themselves are either stored alongside it ("db") or as
+files beneath EREGS_INDEX_BLOB_DIR ("fs"). The latter avoids pushing large
+values through the ORM and lets many processes write contents at once.
+
+Which backend holds each blob is recorded with it, so blobs remain readable
+if the EREGS_INDEX_STORAGE setting changes"""
+import errno
+import mmap
+import os
+import tempfile
+
+from django.conf import settings
+import six
+
+from regparser.index import compression
+
+BACKENDS = ('db', 'fs')
+
+
+def blob_fields(digest, contents, codec=None, storage=None):
+    """Compress and store these contents, returning the fields of the
+    associated Blob. The codec and storage default to the current
+    settings"""
+    if storage is None:
+        storage = settings.EREGS_INDEX_STORAGE
+    if storage not in BACKENDS:
+        raise ValueError("Unknown storage: {}. Options: {}".format(
+            storage, ', '.join(BACKENDS)))
+    if codec is None:
+        codec = settings.EREGS_INDEX_CODEC
+    compressed = compression.codec(codec).compress(contents)
+    if storage == 'fs':
+        _write_file(_path(digest, codec), compressed)
+        compressed = b''
+    return {'contents': compressed, 'codec': codec, 'storage': storage}
+
+
+def read(digest, contents, codec, storage):
+    """Decompressed contents of a blob, given its fields. Where possible, we
+    avoid copying the contents, so this may be a buffer rather than bytes"""
+    if storage == 'fs':
+        contents = _read_file(_path(digest, codec))
+    return compression.codec(codec).decompress(contents)
+
+
+def delete(digest, codec, storage):
+    """Remove any contents stored outside of the database"""
+    if storage == 'fs':
+        try:
+            os.remove(_path(digest, codec))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def _path(digest, codec):
+    """Shard files by the start of their digest to keep directories small.
+    Contents are only ever re-encoded into a new file"""
+    filename = digest[2:]
+    if codec:
+        filename += '.' + codec
+    return os.path.join(settings.EREGS_INDEX_BLOB_DIR, digest[:2], filename)
+
+
+def _write_file(path, contents):
+    """Write to a temporary file, then rename it into place, so that readers
+    never see partial contents. As files are keyed by the digest of their
+    contents, concurrent writers will always agree"""
+    if os.path.exists(path):
+        return
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    handle, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(contents)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_file(path):
+    """Map the file into memory rather than reading it; the mapping remains
+    valid even if the file's later removed. Python 2's mmap objects don't
+    support the buffer interface (bytes() gives their repr), so there we read
+    the file instead"""
+    with open(path, 'rb') as f:
+        if six.PY2:
+            return f.read()
+        if not os.fstat(f.fileno()).st_size:
+            return b''      # empty files can't be mapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -1,6 +1,8 @@
 import abc
 from collections import defaultdict, namedtuple
 
+from regparser.tree import struct
+
 
 SearchReplace = namedtuple('SearchReplace',
                            ['text', 'locations', 'representative'])
@@ -37,16 +39,14 @@ class Layer(object):
 
         raise NotImplementedError()
 
-    def builder(self, node, cache=None):
-        if cache:
-            layer_element = cache.fetch_or_process(self, node)
-        else:
-            layer_element = self.process(node)
-        if layer_element:
-            self.layer[node.label_id()] = layer_element
-
-        for c in node.children:
-            self.builder(c, cache)
+    def builder(self, root, cache=None):
+        for node in struct.iter_nodes(root):
+            if cache:
+                layer_element = cache.fetch_or_process(self, node)
+            else:
+                layer_element = self.process(node)
+            if layer_element:
+                self.layer[node.label_id()] = layer_element
 
     def build(self, cache=None):
         self.pre_process()
@@ -8,6 +8,28 @@ class SectionBySection(Layer):
         super(SectionBySection, self).__init__(tree, **context)
         self.notices = notices
 
+    def referenced_labels(self):
+        """Label ids which these notices' analyses refer to. Only nodes with
+        these labels can appear in the layer"""
+        labels = set()
+        to_visit = [sxs for notice in self.notices
+                    for sxs in notice.get('section_by_section', [])]
+        while to_visit:
+            sxs = to_visit.pop()
+            labels.update(sxs.get('labels', []))
+            to_visit.extend(sxs['children'])
+        return labels
+
+    def build_for(self, nodes):
+        """Equivalent to `build`, but only processes these nodes (e.g. the
+        subtrees with `referenced_labels`), so that the rest of the tree
+        needn't be loaded"""
+        for node in nodes:
+            layer_element = self.process(node)
+            if layer_element:
+                self.layer[node.label_id()] = layer_element
+        return self.layer
+
     def process(self, node):
         """Determine which (if any) section-by-section analyses would apply
         to this node."""
@@ -23,7 +23,7 @@ def node_to_dict(node):
         node.child_labels = [c.label_id() for c in node.children]
 
     node_dict = {}
-    for k, v in node.__dict__.items():
+    for k, v in node.attributes().items():
         if k not in ('children', 'source_xml'):
             node_dict[k] = v
     return node_dict
@@ -259,13 +259,11 @@ def create_subpart_amendment(subpart_node):
 def flatten_tree(node_list, node):
     """ Flatten a tree, removing all hierarchical information, making a
     list out of all the nodes. """
-    for c in node.children:
-        flatten_tree(node_list, c)
-
-    # Don't be destructive.
-    no_kids = copy.deepcopy(node)
-    no_kids.children = []
-    node_list.append(no_kids)
+    for descendant in struct.iter_nodes(node, order='post'):
+        # Don't be destructive, but don't copy the whole subtree either
+        no_kids = copy.copy(descendant)
+        no_kids.children = []
+        node_list.append(copy.deepcopy(no_kids))
 
 
 def pretty_change(change):
@@ -141,8 +141,113 @@ class RegulationTree(object):
     """
 
     def __init__(self, previous_tree):
-        self.tree = copy.deepcopy(previous_tree)
+        # Rather than copying the whole tree, we share nodes with the
+        # previous tree, copying them only when they need to be modified.
+        # See _writable
+        self.tree = previous_tree
         self._kept__by_parent = defaultdict(list)
+        # Indexes of the nodes in the tree, so we needn't search it for each
+        # change. These must be updated whenever the tree's structure
+        # changes; see _set_children
+        self._by_label = defaultdict(list)  # label_id -> nodes
+        self._parents = {}                  # id(node) -> parent node
+        if self.tree is not None:
+            self._index(self.tree, None)
+        self._previous_tree = previous_tree     # keeps the ids below valid
+        self._shared = set(self._parents)
+
+    def _index(self, node, parent):
+        """Add this node and its descendants to the indexes"""
+        to_index = [(node, parent)]
+        while to_index:
+            node, parent = to_index.pop()
+            if id(node) not in self._parents:
+                self._by_label[node.label_id()].append(node)
+            self._parents[id(node)] = parent
+            to_index.extend((child, node) for child in node.children)
+
+    def _unindex(self, node):
+        """Remove this node and its descendants from the indexes"""
+        to_unindex = [node]
+        while to_unindex:
+            node = to_unindex.pop()
+            if self._parents.pop(id(node), False) is False:
+                continue    # not indexed
+            label_id = node.label_id()
+            nodes = [n for n in self._by_label[label_id] if n is not node]
+            if nodes:
+                self._by_label[label_id] = nodes
+            else:
+                del self._by_label[label_id]
+            to_unindex.extend(node.children)
+
+    def _copy_if_shared(self, node):
+        """Shallow copy of the node if it belongs to the previous tree"""
+        if id(node) not in self._shared:
+            return node
+        copied = copy.copy(node)
+        copied.children = list(node.children)
+        return copied
+
+    def _writable(self, node):
+        """Copy-on-write: return a version of this node (which must be in the
+        tree) that can be modified without affecting the previous tree. That
+        may mean copying the node and its ancestors, replacing them in the
+        tree"""
+        copied = self._copy_if_shared(node)
+        if copied is node:
+            return node
+
+        parent = self._parents[id(node)]
+        if parent is None:
+            self.tree = copied
+        else:
+            parent = self._writable(parent)
+            parent.children = [copied if child is node else child
+                               for child in parent.children]
+        del self._parents[id(node)]
+        label_id = node.label_id()
+        self._by_label[label_id] = [copied if n is node else n
+                                    for n in self._by_label[label_id]]
+        self._parents[id(copied)] = parent
+        for child in copied.children:
+            self._parents[id(child)] = copied
+        for kept_nodes in self._kept__by_parent.values():
+            kept_nodes[:] = [copied if n is node else n for n in kept_nodes]
+        return copied
+
+    def _set_children(self, parent, children):
+        """Replace a node's children, updating the indexes to match. Returns
+        the parent, which may have been copied; see _writable"""
+        parent = self._writable(parent)
+        old_ids = set(id(child) for child in parent.children)
+        new_ids = set(id(child) for child in children)
+        for child in parent.children:
+            if id(child) not in new_ids:
+                self._unindex(child)
+        for child in children:
+            if id(child) not in old_ids:
+                self._index(child, parent)
+        parent.children = children
+        return parent
+
+    def _find(self, label_id):
+        """Equivalent to find(self.tree, label_id), but generally without
+        searching the tree"""
+        nodes = self._by_label.get(label_id, [])
+        if len(nodes) > 1:  # find the first in pre-order
+            return find(self.tree, label_id)
+        elif nodes:
+            return nodes[0]
+
+    def _find_parent(self, label_id):
+        """Equivalent to find_parent(self.tree, label_id), but generally
+        without searching the tree"""
+        nodes = self._by_label.get(label_id, [])
+        if len(nodes) > 1:
+            return find_parent(self.tree, label_id)
+        elif nodes:
+            return self._parents[id(nodes[0])]
 
     def keep(self, labels):
         """The 'KEEP' verb tells us that a node should not be removed
@@ -156,10 +261,10 @@ class RegulationTree(object):
 
     def get_parent(self, node):
         """ Get the parent of a node. Returns None if parent not found. """
-        parent = find_parent(self.tree, node)
+        parent = self._find_parent(node.label_id())
         if not parent:  # e.g. because the node doesn't exist in the tree yet
             parent_label_id = get_parent_label(node)
-            parent = find(self.tree, parent_label_id)
+            parent = self._find(parent_label_id)
         if not parent:
             logger.error("Could not find parent of %s. Misparsed amendment?",
                          node.label_id())
@@ -167,15 +272,9 @@ class RegulationTree(object):
 
     def add_to_root(self, node):
         """ Add a child to the root of the tree. """
-        self.tree.children.append(node)
-
-        for c in self.tree.children:
-            c.sortable = make_root_sortable(c.label, c.node_type)
-
-        self.tree.children.sort(key=lambda x: x.sortable)
-
-        for c in self.tree.children:
-            del c.sortable
+        children = self.tree.children + [node]
+        children.sort(key=lambda c: make_root_sortable(c.label, c.node_type))
+        self._set_children(self.tree, children)
 
     def add_child(self, children, node, order=None):
         """ Add a child to the children, and sort appropriately. This is used
@@ -222,11 +321,11 @@ class RegulationTree(object):
 
         parent = self.get_parent(node)
         other_children = [c for c in parent.children if c.label != node.label]
-        parent.children = other_children
+        self._set_children(parent, other_children)
 
     def delete(self, label_id):
         """ Delete the node with label_id from the tree. """
-        node = find(self.tree, label_id)
+        node = self._find(label_id)
         if node is None:
             logger.warning("Attempting to delete %s failed", label_id)
         else:
@@ -238,7 +337,7 @@ class RegulationTree(object):
         represented in the FR XML. We simply use that representation here
         instead of doing something else. """
 
-        existing_node = find(self.tree, label_id)
+        existing_node = self._find(label_id)
         if existing_node is None:
             self.add_node(node)
         else:
@@ -246,9 +345,10 @@ class RegulationTree(object):
 
     def move(self, origin, destination):
         """ Move a node from one part in the tree to another. """
-        origin = find(self.tree, origin)
+        origin = self._find(origin)
         self.delete_from_parent(origin)
 
+        origin = self._copy_if_shared(origin)
         origin = overwrite_marker(origin, destination[-1])
         origin.label = destination
         self.add_node(origin)
@@ -263,22 +363,20 @@ class RegulationTree(object):
         if prev_idx:
             # replace existing element in place
             prev_idx = prev_idx[0]
-            parent.children = (parent.children[:prev_idx] + [node] +
+            self._set_children(parent, parent.children[:prev_idx] + [node] +
                                parent.children[prev_idx + 1:])
         else:
             # actually adding a new element
-            parent.children = self.add_child(parent.children, node,
-                                             getattr(parent, 'child_labels',
-                                                     []))
+            self._set_children(parent, self.add_child(
+                parent.children, node, getattr(parent, 'child_labels', [])))
 
         # Finally, we see if this node is the parent of any 'kept' children.
         # If so, add them back
         label_id = node.label_id()
         if label_id in self._kept__by_parent:
             for kept in self._kept__by_parent[label_id]:
-                node.children = self.add_child(node.children, kept,
-                                               getattr(node, 'child_labels',
-                                                       []))
+                self._set_children(node, self.add_child(
+                    node.children, kept, getattr(node, 'child_labels', [])))
 
     def create_empty_node(self, node_label):
         """ In rare cases, we need to flush out the tree by adding
@@ -294,8 +392,8 @@ class RegulationTree(object):
         parent = self.get_parent(node)
         if not parent:
             parent = self.create_empty_node(get_parent_label(node))
-        parent.children = self.add_child(parent.children, node,
-                                         getattr(parent, 'child_labels', []))
+        self._set_children(parent, self.add_child(
+            parent.children, node, getattr(parent, 'child_labels', [])))
         return node
 
     def contains(self, label):
@@ -306,15 +404,16 @@ class RegulationTree(object):
     def find_node(self, label):
         if isinstance(label, list):
             label = '-'.join(label)
-        return find(self.tree, label)
+        return self._find(label)
 
     def add_node(self, node, parent_label=None):
         """ Add an entirely new node to the regulation tree. """
-        existing = find(self.tree, node.label_id())
+        existing = self._find(node.label_id())
         if existing and is_reserved_node(existing):
             logger.warning('Replacing reserved node: %s' % node.label_id())
             return self.replace_node_and_subtree(node)
         elif existing and is_interp_placeholder(existing):
+            existing = self._writable(existing)
             existing.title = node.title
             existing.text = node.text
             if hasattr(node, 'tagged_text'):
@@ -351,9 +450,9 @@ class RegulationTree(object):
                 if (parent.children and
                         parent.children[0].node_type == Node.EMPTYPART):
                     parent = parent.children[0]
-                parent.children = self.add_child(
+                self._set_children(parent, self.add_child(
                     parent.children, node, getattr(parent, 'child_labels',
-                                                   []))
+                                                   [])))
 
     def insert_in_order(self, node):
         """Add a new node, but determine its position in its parent by looking
@@ -361,24 +460,25 @@ class RegulationTree(object):
         parent = self.get_parent(node)
         texts = [child.text for child in parent.children]
         insert_idx = bisect(texts, node.text)
-        parent.children.insert(insert_idx, node)
+        self._set_children(parent, parent.children[:insert_idx] + [node] +
+                           parent.children[insert_idx:])
 
     def replace_node_text(self, label, change):
         """ Replace just a node's text. """
 
-        node = find(self.tree, label)
+        node = self._writable(self._find(label))
         node.text = change['node']['text']
 
     def replace_node_title(self, label, change):
         """ Replace just a node's title. """
 
-        node = find(self.tree, label)
+        node = self._writable(self._find(label))
         node.title = change['node']['title']
 
     def replace_node_heading(self, label, change):
         """ A node's heading is it's keyterm. We handle this here, but not
         well, I think. """
-        node = find(self.tree, label)
+        node = self._writable(self._find(label))
         node.text = replace_first_sentence(node.text, change['node']['text'])
 
         if hasattr(node, 'tagged_text') and 'tagged_text' in change['node']:
@@ -402,19 +502,21 @@ class RegulationTree(object):
                 label, subpart_label)
             return
 
-        destination = find(self.tree, '-'.join(subpart_label))
+        destination = self._find('-'.join(subpart_label))
 
         if destination is None:
             destination = self.create_new_subpart(subpart_label)
 
-        subpart_with_node = find_parent(self.tree, label)
+        subpart_with_node = self._find_parent(label)
 
         if destination and subpart_with_node:
             node = find(subpart_with_node, label)
             other_children = [c for c in subpart_with_node.children
                               if c.label_id() != label]
-            subpart_with_node.children = other_children
-            destination.children = self.add_child(destination.children, node)
+            subpart_with_node = self._set_children(subpart_with_node,
+                                                   other_children)
+            self._set_children(destination, self.add_child(
+                destination.children, node))
 
             if not subpart_with_node.children:
                 self.delete('-'.join(subpart_with_node.label))
@@ -508,7 +610,8 @@ def _needs_delay(reg, change):
 
 def compile_regulation(previous_tree, notice_changes):
     """ Given a last full regulation tree, and the set of changes from the
-    next final notice, construct the next full regulation tree. """
+    next final notice, construct the next full regulation tree. The previous
+    tree isn't modified; the new tree shares any unchanged nodes with it. """
     reg = RegulationTree(previous_tree)
     labels = sort_labels(notice_changes.keys())
 
@@ -0,0 +1,380 @@
+"""Compact binary encoding of Node trees, an alternative to JSON (see
+FullNodeEncoder) for storing trees in the index. Layout:
+
+    magic (4 bytes) | version (1 byte) |
+    string count, int count, string table length, index length, digest
+    algorithm (uint32 each) |
+    string ends (uint32 each) | ints (uint32 each) |
+    label index (uint32 each) | string table (utf-8)
+
+Every string (text, labels, node types, xml, etc.) is stored once in the
+string table and referenced by index. Each string's end is its offset (in
+bytes) from the start of the string table, so strings can be decoded
+individually, as they're needed. Nodes are encoded in pre-order as a
+sequence of ints:
+
+    flags, end, text, node_type, label length, *label, [title],
+    [tagged_text], [source_xml], [digest], child count
+
+where the bracketed fields are only present if indicated by the flags and
+`end` is the position just past the node's last descendant, which lets us
+skip over subtrees. The label index holds pairs of (label id, position of
+the node) so that subtrees can be found without decoding the whole tree;
+see `decode_subtrees`. Digests (see FrozenNode.hash) are optional; if present,
+the header references the name of the algorithm used to compute them (plus
+one, as zero indicates there are no digests). All ints are little-endian,
+so that they can be decoded in bulk."""
+from array import array
+from bisect import bisect_right
+import codecs
+from functools import partial
+import sys
+
+from django.conf import settings
+from lxml import etree
+import six
+
+from regparser.tree.struct import FrozenNode, iter_nodes, Node, node_digest
+
+MAGIC = b'\x00RGT'     # JSON never starts with a null byte
+VERSION = 1
+_TITLE, _TAGGED_TEXT, _SOURCE_XML, _DIGEST = 1, 2, 4, 8
+_HEADER_LEN = 5
+_UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+_PREFIX_LEN = len(MAGIC) + 1
+
+
+def is_packed(content):
+    """Is this content (bytes or a buffer) in this format, rather than
+    JSON?"""
+    return bytes(content[:len(MAGIC)]) == MAGIC
+
+
+def digests_of(root):
+    """Digest of each node in the tree (see FrozenNode.hash), keyed by the
+    node's id"""
+    digests = {}
+    for node in iter_nodes(root, order='post'):
+        if isinstance(node, FrozenNode):
+            digests[id(node)] = node.hash
+        else:
+            digests[id(node)] = node_digest(
+                node.text or '', getattr(node, 'tagged_text', '') or '',
+                node.title or '', node.label_id(), node.node_type,
+                [digests[id(child)] for child in node.children])
+    return digests
+
+
+def encode(root, digests=False):
+    """Encode a tree of Nodes (or FrozenNodes) as bytes. If `digests` is
+    set, also include the digest of each node, so that they needn't be
+    computed when decoding into FrozenNodes"""
+    strings, string_ids, ints, index = [], {}, [], []
+
+    def intern(string):
+        if string not in string_ids:
+            string_ids[string] = len(strings)
+            strings.append(string)
+        return string_ids[string]
+
+    digest_algorithm = 0
+    if digests:
+        digests = digests_of(root)
+        digest_algorithm = intern(settings.EREGS_NODE_DIGEST) + 1
+
+    # Entries are either nodes to encode or, once all of a node's
+    # descendants have been encoded, the position of its `end` field
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, int):
+            ints[node] = len(ints)
+            continue
+        index.extend((intern(u'-'.join(node.label)), len(ints)))
+        title = node.title
+        tagged_text = getattr(node, 'tagged_text', None)
+        source_xml = getattr(node, 'source_xml', None)
+        flags = ((_TITLE if title else 0) |
+                 (_TAGGED_TEXT if tagged_text else 0) |
+                 (_SOURCE_XML if source_xml is not None else 0) |
+                 (_DIGEST if digests else 0))
+        stack.append(len(ints) + 1)
+        ints.extend((flags, 0, intern(node.text), intern(node.node_type),
+                     len(node.label)))
+        ints.extend(intern(six.text_type(part)) for part in node.label)
+        if title:
+            ints.append(intern(title))
+        if tagged_text:
+            ints.append(intern(tagged_text))
+        if source_xml is not None:
+            ints.append(intern(etree.tounicode(source_xml)))
+        if digests:
+            ints.append(intern(digests[id(node)]))
+        ints.append(len(node.children))
+        # Pre-order: children are popped in their original order
+        stack.extend(reversed(node.children))
+
+    encoded, ends = [], []
+    for string in strings:
+        encoded.append(string.encode('utf-8'))
+        ends.append(len(encoded[-1]) + (ends[-1] if ends else 0))
+    string_table = b''.join(encoded)
+    header = _uints([len(strings), len(ints), len(string_table), len(index),
+                     digest_algorithm])
+    return b''.join([MAGIC, bytes(bytearray([VERSION])), _to_bytes(header),
+                     _to_bytes(_uints(ends)), _to_bytes(_uints(ints)),
+                     _to_bytes(_uints(index)), string_table])
+
+
+class _Packed(object):
+    """The tables of a packed tree. Where possible, these are views of the
+    encoded content rather than copies; strings are only decoded when
+    requested"""
+    def __init__(self, content):
+        if not is_packed(content):
+            raise ValueError("Not a packed tree")
+        version = bytearray(bytes(content[len(MAGIC):_PREFIX_LEN]))[0]
+        if version != VERSION:
+            raise ValueError("Unsupported packed tree version: {}".format(
+                version))
+        offset = _PREFIX_LEN + 4 * _HEADER_LEN
+        num_strings, num_ints, table_len, index_len, digest_algorithm = \
+            _from_bytes(content[_PREFIX_LEN:offset])
+
+        self._ends = _uint_view(content, offset, num_strings)
+        offset += 4 * num_strings
+        self.ints = _uint_view(content, offset, num_ints)
+        offset += 4 * num_ints
+        self.index = _uint_view(content, offset, index_len)
+        offset += 4 * index_len
+        self._table = _byte_view(content, offset, table_len)
+
+        self._strings = {}
+        self.digest_algorithm = None
+        if digest_algorithm:
+            self.digest_algorithm = self.string(digest_algorithm - 1)
+
+    def string(self, idx):
+        """Decode (and remember) a single string from the string table"""
+        if idx not in self._strings:
+            start = self._ends[idx - 1] if idx else 0
+            self._strings[idx] = codecs.decode(
+                self._table[start:self._ends[idx]], 'utf-8')
+        return self._strings[idx]
+
+    def all_strings(self):
+        """Decode the whole string table, for when every string will be
+        needed"""
+        table, ends = bytes(self._table), self._ends.tolist()
+        return [table[start:end].decode('utf-8')
+                for start, end in zip([0] + ends[:-1], ends)]
+
+    def decode(self, make_node, position=0):
+        """Decode the (whole) subtree at this position. Digests are only
+        provided if they match our current algorithm"""
+        strings = self.all_strings()
+        use_digests = (self.digest_algorithm == settings.EREGS_NODE_DIGEST)
+        next_int = partial(next, iter(self.ints[position:].tolist()))
+
+        def next_node():
+            flags = next_int()
+            next_int()      # end; only needed when skipping subtrees
+            text = strings[next_int()]
+            node_type = strings[next_int()]
+            label = [strings[next_int()] for _ in range(next_int())]
+            title = strings[next_int()] if flags & _TITLE else None
+            tagged_text = (strings[next_int()] if flags & _TAGGED_TEXT
+                           else None)
+            source_xml = strings[next_int()] if flags & _SOURCE_XML else None
+            digest = strings[next_int()] if flags & _DIGEST else None
+            children = [next_node() for _ in range(next_int())]
+            return make_node(text, children, label, title, node_type,
+                             tagged_text, source_xml,
+                             digest if use_digests else None)
+
+        return next_node()
+
+    def node_fields(self, position):
+        """Decode only the node at this position, returning its
+        fields and the positions of its children"""
+        ints, string = self.ints, self.string
+        flags, _, text, node_type, label_len = ints[position:position + 5]
+        position += 5
+        label = [string(idx) for idx in ints[position:position + label_len]]
+        position += label_len
+        optional = []
+        for flag in (_TITLE, _TAGGED_TEXT, _SOURCE_XML):
+            if flags & flag:
+                optional.append(string(ints[position]))
+                position += 1
+            else:
+                optional.append(None)
+        title, tagged_text, source_xml = optional
+        if flags & _DIGEST:
+            position += 1
+
+        child_positions = []
+        position += 1
+        for _ in range(ints[position - 1]):
+            child_positions.append(position)
+            position = ints[position + 1]     # the child's `end`
+        return ((string(text), label, title, string(node_type),
+                 tagged_text, source_xml), child_positions)
+
+    def positions_of(self, label_ids):
+        """Find the positions of the (first) nodes with these labels via the
+        label index. Returns a dictionary keyed by label id; labels which
+        aren't present are omitted"""
+        table, ends = bytes(self._table), self._ends.tolist()
+        labels = self.index[0::2].tolist()
+        positions = {}
+        for label_id in label_ids:
+            try:
+                idx = labels.index(_find_string(table, ends, label_id))
+            except ValueError:
+                continue
+            positions[label_id] = self.index[2 * idx + 1]
+        return positions
+
+
+def _find_string(table, ends, string):
+    """Index of this string within the encoded string table, or None if it's
+    not present. Found by searching the bytes, so that the other strings
+    needn't be decoded"""
+    target = string.encode('utf-8')
+    start = table.find(target)
+    while start != -1:
+        # The string containing this byte; must match it exactly
+        idx = bisect_right(ends, start)
+        if idx < len(ends) and ends[idx] == start + len(target) and \
+                start == (ends[idx - 1] if idx else 0):
+            return idx
+        start = table.find(target, start + 1)
+
+
+def _full_node(text, children, label, title, node_type, tagged_text,
+               source_xml, digest):
+    """Mirrors full_node_decode_hook"""
+    if source_xml is not None:
+        source_xml = etree.fromstring(source_xml)
+    return Node(text, children, label, title, node_type, source_xml,
+                tagged_text or None)
+
+
+def _frozen_node(text, children, label, title, node_type, tagged_text,
+                 source_xml, digest):
+    """Mirrors frozen_node_decode_hook"""
+    return FrozenNode(text, children, label, title, node_type,
+                      tagged_text, digest)
+
+
+def decode(content, make_node=_full_node):
+    """Decode bytes (or a buffer) into a tree. `make_node` determines the
+    class of the resulting nodes"""
+    return _Packed(content).decode(make_node)
+
+
+def decode_full(content):
+    """Decode into Nodes, including their source_xml"""
+    return decode(content, _full_node)
+
+
+def decode_frozen(content):
+    """Decode into FrozenNodes"""
+    return decode(content, _frozen_node)
+
+
+class LazyNode(Node):
+    """A Node whose children and source_xml are only decoded (from a packed
+    tree) when first accessed. Otherwise, it behaves like any other Node,
+    including being modifiable"""
+    __slots__ = ('_packed', '_child_positions', '_children',
+                 '_raw_source_xml', '_source_xml')
+
+    def __init__(self, packed, position):
+        fields, self._child_positions = packed.node_fields(position)
+        text, label, title, node_type, tagged_text, source_xml = fields
+        super(LazyNode, self).__init__(text, (), label, title, node_type,
+                                       tagged_text=tagged_text or None)
+        self._packed = packed
+        self._children = None
+        self._raw_source_xml = source_xml
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [LazyNode(self._packed, position)
+                              for position in self._child_positions]
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+
+    @property
+    def source_xml(self):
+        if self._raw_source_xml is not None:
+            self._source_xml = etree.fromstring(self._raw_source_xml)
+            self._raw_source_xml = None
+        return self._source_xml
+
+    @source_xml.setter
+    def source_xml(self, source_xml):
+        self._source_xml = source_xml
+        self._raw_source_xml = None
+
+
+def decode_lazy(content, label_id=None):
+    """Decode only the root of the tree (or, if provided, the subtree with
+    this label id) as a LazyNode; its descendants will be decoded as they
+    are accessed. Returns None if the label isn't present"""
+    if label_id is None:
+        return LazyNode(_Packed(content), 0)
+    return decode_subtrees(content, [label_id]).get(label_id)
+
+
+def decode_subtrees(content, label_ids):
+    """Decode the subtrees with these label ids as LazyNodes, which share
+    the tree's tables. Returns a dictionary keyed by label id; labels which
+    aren't present are omitted"""
+    packed = _Packed(content)
+    return {label_id: LazyNode(packed, position)
+            for label_id, position in packed.positions_of(label_ids).items()}
+
+
+def _uints(values):
+    arr = array(_UINT32, values)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def _uint_view(content, offset, count):
+    """Uint32s from this section of the content. If they're already in our
+    byte order, avoid copying them"""
+    if six.PY3 and sys.byteorder == 'little':
+        return memoryview(content)[offset:offset + 4 * count].cast(_UINT32)
+    return _from_bytes(content[offset:offset + 4 * count])
+
+
+def _byte_view(content, offset, length):
+    """Bytes from this section of the content, avoiding a copy where we
+    can"""
+    if six.PY3:
+        return memoryview(content)[offset:offset + length]
+    return bytes(content[offset:offset + length])
+
+
+def _to_bytes(arr):
+    return arr.tobytes() if six.PY3 else arr.tostring()
+
+
+def _from_bytes(content):
+    arr = array(_UINT32)
+    if six.PY3:
+        arr.frombytes(content)
+    else:
+        arr.fromstring(bytes(content))
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
@@ -1,9 +1,13 @@
+from collections import defaultdict, OrderedDict
 import re
 from json import JSONEncoder
 import hashlib
+import weakref
 
+from django.conf import settings
 from lxml import etree
 import six
+from six.moves import intern
 
 from regparser.tree.depth.markers import MARKERLESS
 
@@ -21,6 +25,11 @@ class Node(object):
 
     MARKERLESS_REGEX = re.compile(r'p\d+')
 
+    # Avoid a per-instance __dict__; we hold a great many nodes at once.
+    # `tagged_text` and `child_labels` are only set when present
+    __slots__ = ('text', 'children', 'label', 'title', 'node_type',
+                 'source_xml', 'tagged_text', 'child_labels')
+
     def __init__(self, text='', children=[], label=[], title=None,
                  node_type=REGTEXT, source_xml=None, tagged_text=None):
 
@@ -29,7 +38,8 @@ class Node(object):
         # defensive copy
         self.children = list(children)
 
-        self.label = [str(l) for l in label if l != '']
+        # Labels repeat across versions, so share their strings
+        self.label = [intern(str(l)) for l in label if l != '']
         title = six.text_type(title or '')
         self.title = title or None
         self.node_type = node_type
@@ -45,15 +55,53 @@ class Node(object):
                  "node_type = %s)") % (repr(self.text), repr(self.children),
                 repr(self.label), repr(self.title), repr(self.node_type)))
 
+    def _sort_key(self):
+        return (self.label, self.node_type, self.title or '', self.text,
+                self.children)
+
     def __lt__(self, other):
-        return repr(self) < repr(other)
+        return self._sort_key() < other._sort_key()
 
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        """Nodes are equal if their text, label, title, node_type and
+        children (recursively) are. Shared subtrees (e.g. between compiled
+        versions) are not re-examined"""
+        if not isinstance(other, Node):
+            return NotImplemented
+        to_compare = [(self, other)]
+        while to_compare:
+            lhs, rhs = to_compare.pop()
+            if lhs is rhs:
+                continue
+            if not isinstance(rhs, Node) or not isinstance(lhs, Node):
+                return False
+            if (lhs.label != rhs.label or lhs.node_type != rhs.node_type or
+                    lhs.title != rhs.title or lhs.text != rhs.text or
+                    len(lhs.children) != len(rhs.children)):
+                return False
+            to_compare.extend(zip(lhs.children, rhs.children))
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None     # mutable
 
     def label_id(self):
         return '-'.join(self.label)
 
+    def attributes(self):
+        """The node's public attributes, as a dictionary. Stands in for
+        __dict__, which nodes don't have (see __slots__)"""
+        attributes = {slot: getattr(self, slot) for slot in Node.__slots__
+                      if hasattr(self, slot)}
+        # Subclasses may not use __slots__
+        for key, value in getattr(self, '__dict__', {}).items():
+            if not key.startswith('_'):
+                attributes[key] = value
+        return attributes
+
     def depth(self):
         """Inspect the label and type to determine the node's depth"""
         second = (self.label[1:2] or [""])[0]
@@ -93,7 +141,7 @@ class NodeEncoder(JSONEncoder):
     """Custom JSON encoder to handle Node objects"""
     def default(self, obj):
         if isinstance(obj, Node):
-            fields = dict(obj.__dict__)
+            fields = obj.attributes()
             if obj.title is None:
                 del fields['title']
             for field in ('tagged_text', 'source_xml', 'child_labels'):
@@ -146,36 +194,53 @@ def frozen_node_decode_hook(d):
     if set(d.keys()) == FullNodeEncoder.FIELDS:
         params = dict(d)
         del(params['source_xml'])
-        fresh = FrozenNode(**params)
-        return fresh.prototype()
+        return FrozenNode(**params)
     return d
 
 
+def iter_nodes(root, order='pre'):
+    """Generate every node in the tree, in either pre- ('pre') or post-order
+    ('post'). Iterative, so deep trees won't hit the recursion limit, and
+    lazy, so consumers can stop early. In pre-order, a node's children are
+    only looked up after it's been consumed, so they may be modified in the
+    meantime"""
+    if order == 'pre':
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+    elif order == 'post':
+        # Entries are (node, whether its children have been visited)
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in reversed(node.children))
+    else:
+        raise ValueError("Unknown order: {}".format(order))
+
+
 def walk(node, fn):
     """Perform fn for every node in the tree. Pre-order traversal. fn must
-    be a function that accepts a root node."""
-    result = fn(node)
-
-    if result is not None:
-        results = [result]
-    else:
-        results = []
-    for child in node.children:
-        results += walk(child, fn)
-    return results
+    be a function that accepts a root node. Returns the non-None results"""
+    results = (fn(n) for n in iter_nodes(node))
+    return [result for result in results if result is not None]
 
 
 def filter_walk(node, fn):
     """Perform fn on the label for every node in the tree and return a
     list of nodes on which the function returns truthy."""
-    return walk(node, lambda n: n if fn(n.label) else None)
+    return [n for n in iter_nodes(node) if fn(n.label)]
 
 
 def find_first(root, predicate):
     """Walk the tree and find the first node which matches the predicate"""
-    response = walk(root, lambda n: n if predicate(n) else None)
-    if response:
-        return response[0]
+    return next((n for n in iter_nodes(root) if predicate(n)), None)
 
 
 def find(root, label):
@@ -199,19 +264,15 @@ def find_parent(root, label):
 
 def merge_duplicates(nodes):
     """Given a list of nodes with the same-length label, merge any
-    duplicates (by combining their children)"""
-    found_pair = None
-    for lidx, lhs in enumerate(nodes):
-        for ridx, rhs in enumerate(nodes[lidx + 1:], lidx + 1):
-            if lhs.label == rhs.label:
-                found_pair = (lidx, ridx)
-    if found_pair:
-        lidx, ridx = found_pair
-        lhs, rhs = nodes[lidx], nodes[ridx]
-        lhs.children.extend(rhs.children)
-        return merge_duplicates(nodes[:ridx] + nodes[ridx + 1:])
-    else:
-        return nodes
+    duplicates (by combining their children) into the first of each"""
+    by_label = OrderedDict()
+    for node in nodes:
+        label = tuple(node.label)
+        if label in by_label:
+            by_label[label].children.extend(node.children)
+        else:
+            by_label[label] = node
+    return list(by_label.values())
 
 
 def treeify(nodes):
@@ -221,36 +282,88 @@ def treeify(nodes):
     if not nodes:
         return nodes
 
-    min_len, with_min = len(nodes[0].label), []
+    min_len = min(len(node.label) for node in nodes)
+    roots = merge_duplicates([node for node in nodes
+                              if len(node.label) == min_len])
 
-    for node in nodes:
-        if len(node.label) == min_len:
-            with_min.append(node)
-        elif len(node.label) < min_len:
-            min_len = len(node.label)
-            with_min = [node]
-    with_min = merge_duplicates(with_min)
-
-    roots = []
-    for root in with_min:
-        label = root.label
+    def prefix_of(root):
         if root.label[-1] == Node.INTERP_MARK:
-            label = root.label[:-1]
-
-        def is_child(node):
-            return node.label[:len(label)] == label
-        children = [n for n in nodes if n.label != root.label and is_child(n)]
+            return tuple(root.label[:-1])
+        return tuple(root.label)
+
+    # Rather than scanning all of the nodes for each root, group them by
+    # each length of prefix we'll be looking up
+    by_prefix = {}
+    for length in set(len(prefix_of(root)) for root in roots):
+        groups = by_prefix[length] = defaultdict(list)
+        for node in nodes:
+            groups[tuple(node.label[:length])].append(node)
+
+    for root in roots:
+        prefix = prefix_of(root)
+        children = [n for n in by_prefix[len(prefix)].get(prefix, [])
+                    if n.label != root.label]
         root.children = root.children + treeify(children)
-        roots.append(root)
     return roots
 
 
+def node_digest(text, tagged_text, title, label_id, node_type,
+                child_digests):
+    """Digest of a node's fields and its children's digests (making a Merkle
+    tree), using the EREGS_NODE_DIGEST algorithm. See FrozenNode.hash"""
+    algorithm = settings.EREGS_NODE_DIGEST
+    if algorithm == 'blake2b':
+        hasher = hashlib.blake2b(digest_size=32)
+    else:
+        hasher = getattr(hashlib, algorithm)()
+    hasher.update(text.encode('utf-8'))
+    hasher.update(tagged_text.encode('utf-8'))
+    hasher.update(title.encode('utf-8'))
+    hasher.update(label_id.encode('utf-8'))
+    hasher.update(node_type.encode('utf-8'))
+    for child_digest in child_digests:
+        hasher.update(child_digest.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class InternPool(object):
+    """FrozenNodes, keyed by hash, so that only one of each identical node
+    need exist in memory. Only weak references are held: nodes are released
+    once nothing else refers to them, so long-lived processes don't
+    accumulate every node they've ever seen"""
+    def __init__(self):
+        self._nodes = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, node):
+        """Return the live node with the same hash as this one, or, if
+        there isn't one, add (and return) this node"""
+        existing = self._nodes.get(node.hash)
+        if existing is not None:
+            self.hits += 1
+            return existing
+        self.misses += 1
+        self._nodes[node.hash] = node
+        return node
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def clear(self):
+        self._nodes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 class FrozenNode(object):
     """Immutable interface for nodes. No guarantees about internal state."""
-    _pool = {}    # collection of all FrozenNodes, keyed by hash
+    _pool = InternPool()
 
     def __init__(self, text='', children=(), label=(), title='',
-                 node_type=Node.REGTEXT, tagged_text=''):
+                 node_type=Node.REGTEXT, tagged_text='', digest=None):
+        """If known (e.g. from when the node was serialized), the node's
+        digest can be provided. Otherwise, it's computed when needed"""
         self._text = text or ''
         self._children = tuple(children)
         self._label = tuple(label)
@@ -259,9 +372,9 @@ class FrozenNode(object):
         self._tagged_text = tagged_text or ''
         self._child_labels = tuple(c.label_id for c in self.children)
         self._label_id = '-'.join(self.label)
-        self._hash = self._generate_hash()
-        if self.hash not in FrozenNode._pool:
-            FrozenNode._pool[self.hash] = self
+        self._hash = digest
+        self._interned = False
+        self._prototype = None
 
     @property
     def text(self):
@@ -289,6 +402,8 @@ class FrozenNode(object):
 
     @property
     def hash(self):
+        if self._hash is None:
+            self._hash = self._generate_hash()
         return self._hash
 
     @property
@@ -300,16 +415,14 @@ class FrozenNode(object):
         return self._child_labels
 
     def _generate_hash(self):
-        """Called during instantiation. Digests all fields"""
-        hasher = hashlib.sha256()
-        hasher.update(self.text.encode('utf-8'))
-        hasher.update(self.tagged_text.encode('utf-8'))
-        hasher.update(self.title.encode('utf-8'))
-        hasher.update(self.label_id.encode('utf-8'))
-        hasher.update(self.node_type.encode('utf-8'))
-        for child in self.children:
-            hasher.update(child.hash.encode('utf-8'))
-        return hasher.hexdigest()
+        """Called on first use of the hash (if it wasn't provided). Digests
+        all fields. As this needs the children's hashes, they're also swapped
+        for their prototypes, so identical subtrees (e.g. from different
+        versions of a tree) share memory once they've been compared"""
+        self._children = tuple(child.prototype() for child in self.children)
+        return node_digest(self.text, self.tagged_text, self.title,
+                           self.label_id, self.node_type,
+                           [child.hash for child in self.children])
 
     def __hash__(self):
         """As the hash property is already distinctive, re-use it"""
@@ -344,11 +457,21 @@ class FrozenNode(object):
 
     # @todo - seems like something we could implement via __new__?
     def prototype(self):
-        """When we instantiate a FrozenNode, we add it to _pool if we've not
-        seen an identical FrozenNode before. If we have, we want to work with
-        that previously seen version instead. This method returns the _first_
-        FrozenNode with identical fields"""
-        return FrozenNode._pool[self.hash]  # note this may not be self
+        """The first time this is called, we add this node to _pool if we've
+        not seen an identical FrozenNode before. If we have, we want to work
+        with that previously seen version instead. This method returns the
+        _first_ live FrozenNode with identical fields (which may not be
+        self)"""
+        if not self._interned:
+            self._interned = True
+            prototype = FrozenNode._pool.intern(self)
+            # Holding the prototype keeps it in the pool while we're alive.
+            # Avoid a reference cycle when we are the prototype
+            if prototype is not self:
+                self._prototype = prototype
+        if self._prototype is None:
+            return self
+        return self._prototype
 
     def clone(self, **kwargs):
         """Implement a namedtuple `_replace` style functionality, copying all
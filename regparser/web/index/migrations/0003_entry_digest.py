@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-17 06:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('index', '0002_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='changed',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='digest',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
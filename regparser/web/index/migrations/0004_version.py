@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-17 06:27
+from __future__ import unicode_literals
+
+import json
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def add_version_metadata(apps, schema_editor):
+    """Populate metadata for any existing version entries"""
+    Entry = apps.get_model('index', 'Entry')
+    Version = apps.get_model('index', 'Version')
+    prefix = os.path.join(settings.EREGS_INDEX_ROOT, 'version') + os.sep
+    for entry in Entry.objects.filter(label__label__startswith=prefix):
+        try:
+            as_dict = json.loads(bytes(entry.contents).decode('utf-8'))
+            Version.objects.create(
+                entry=entry, identifier=as_dict['identifier'],
+                published=as_dict['published'],
+                effective=as_dict.get('effective'))
+        except (ValueError, KeyError):
+            continue
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('index', '0003_entry_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Version',
+            fields=[
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='index.Entry')),
+                ('identifier', models.CharField(max_length=512)),
+                ('published', models.DateField()),
+                ('effective', models.DateField(db_index=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(add_version_metadata,
+                             migrations.RunPython.noop),
+    ]
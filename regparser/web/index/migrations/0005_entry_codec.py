@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-17 06:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('index', '0004_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='codec',
+            field=models.CharField(blank=True, max_length=8),
+        ),
+    ]
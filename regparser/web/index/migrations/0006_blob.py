@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-17 06:32
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from regparser.index import compression
+
+
+def move_contents_to_blobs(apps, schema_editor):
+    """Store the contents of existing entries as blobs"""
+    Blob = apps.get_model('index', 'Blob')
+    Entry = apps.get_model('index', 'Entry')
+    for entry in Entry.objects.all().iterator():
+        contents = compression.codec(entry.codec).decompress(entry.contents)
+        digest = hashlib.sha256(contents).hexdigest()
+        Blob.objects.get_or_create(digest=digest, defaults={
+            'contents': entry.contents, 'codec': entry.codec})
+        # update() rather than save() so the modification time is unchanged
+        Entry.objects.filter(pk=entry.pk).update(blob=digest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('index', '0005_entry_codec'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('contents', models.BinaryField()),
+                ('codec', models.CharField(blank=True, max_length=8)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='index.Blob'),
+        ),
+        migrations.RunPython(move_contents_to_blobs),
+        migrations.RemoveField(
+            model_name='entry',
+            name='codec',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='contents',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='digest',
+        ),
+        migrations.AlterField(
+            model_name='entry',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='index.Blob'),
+        ),
+    ]
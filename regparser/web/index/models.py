@@ -10,10 +10,33 @@ class Dependency(models.Model):
     depender = models.ForeignKey(DependencyNode, related_name='depends_on')
 
 
+class Blob(models.Model):
+    """Entry contents, keyed by the sha256 of their (uncompressed) value, so
+    that identical contents are only stored once"""
+    digest = models.CharField(max_length=64, primary_key=True)
+    contents = models.BinaryField()
+    # See regparser.index.compression
+    codec = models.CharField(max_length=8, blank=True)
+    # See regparser.index.storage
+    storage = models.CharField(max_length=8, default='db')
+
+
 class Entry(models.Model):
     label = models.OneToOneField(DependencyNode, primary_key=True)
     modified = models.DateTimeField(auto_now=True)
-    contents = models.BinaryField()
+    blob = models.ForeignKey(Blob, related_name='entries')
+    # When the contents last differed from what was previously written; used
+    # for digest-based staleness
+    changed = models.DateTimeField(null=True)
 
     class Meta:
         ordering = ['label']
+
+
+class Version(models.Model):
+    """Metadata for version entries, so they can be listed and sorted without
+    deserializing each"""
+    entry = models.OneToOneField(Entry, primary_key=True)
+    identifier = models.CharField(max_length=512)
+    published = models.DateField()
+    effective = models.DateField(null=True, db_index=True)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
+import hashlib
 import os
 
 import dj_database_url
@@ -133,6 +134,33 @@ RQ_QUEUES = {
 
 
 EREGS_INDEX_ROOT = os.environ.get('EREGS_CACHE_DIR', '.eregs_index')
+# If set, index entries are only considered updated when their contents
+# change, rather than whenever they are written
+EREGS_DIGEST_STALENESS = bool(os.environ.get('EREGS_DIGEST_STALENESS'))
+# How to compress index entries: one of '' (no compression), 'zlib', 'lzma'
+# (Python 3) or 'zstd' (if zstandard is installed)
+EREGS_INDEX_CODEC = os.environ.get('EREGS_INDEX_CODEC', '')
+# Where index contents are stored: 'db' (in the database, with the rest of the
+# index) or 'fs' (as files beneath EREGS_INDEX_BLOB_DIR, which avoids passing
+# large values through the database)
+EREGS_INDEX_STORAGE = os.environ.get('EREGS_INDEX_STORAGE', 'db')
+EREGS_INDEX_BLOB_DIR = os.environ.get(
+    'EREGS_INDEX_BLOB_DIR', os.path.join(EREGS_INDEX_ROOT, 'blobs'))
+# Number of index entries to keep in memory (per process) after reading them.
+# Immutable values are kept deserialized; others as their contents, which are
+# deserialized again on each read. 0 disables the cache
+EREGS_INDEX_CACHE_SIZE = int(os.environ.get('EREGS_INDEX_CACHE_SIZE', 0))
+# How trees are serialized in the index: 'json' or 'packed' (a compact binary
+# format; see regparser.tree.packed). Either can be read regardless
+EREGS_TREE_FORMAT = os.environ.get('EREGS_TREE_FORMAT', 'json')
+# hashlib algorithm used to digest tree nodes when comparing them (see
+# FrozenNode.hash)
+EREGS_NODE_DIGEST = os.environ.get(
+    'EREGS_NODE_DIGEST',
+    'blake2b' if hasattr(hashlib, 'blake2b') else 'sha256')
+# If set, packed trees include the digest of each node, so that they needn't
+# be recomputed when reading trees as FrozenNodes
+EREGS_TREE_DIGESTS = os.environ.get('EREGS_TREE_DIGESTS', 'true') == 'true'
 
 REQUESTS_CACHE = {
     'backend': 'sqlite',
@@ -1,3 +1,4 @@
+from io import BytesIO
 import json
 import os
 import shutil
@@ -61,6 +62,12 @@ class FSWriteContentTest(TestCase):
         self.assertEqual(self.read("replace", "it"),
                          ['action', ['label'], ['destination']])
 
+    def test_write_stream(self):
+        writer = FSWriteContent(self.tmpdir, "a", "path")
+        writer.write_stream(BytesIO(b'{"testing": ["body", 1, 2]}'))
+
+        self.assertEqual(self.read("a", "path"), {'testing': ['body', 1, 2]})
+
 
 class APIWriteContentTest(HttpMixin, TestCase):
     def test_write(self):
@@ -73,6 +80,15 @@ class APIWriteContentTest(HttpMixin, TestCase):
                          'application/json')
         self.assertEqual(self.last_http_body(), data)
 
+    def test_write_stream(self):
+        writer = APIWriteContent("http://example.com", "a", "path")
+        self.expect_json_http(method='POST', uri='http://example.com/a/path')
+        writer.write_stream(BytesIO(b'{"testing": ["body", 1, 2]}'))
+
+        self.assertEqual(self.last_http_headers()['content-type'],
+                         'application/json')
+        self.assertEqual(self.last_http_body(), {'testing': ['body', 1, 2]})
+
 
 class GitWriteContentTest(TestCase):
     def setUp(self):
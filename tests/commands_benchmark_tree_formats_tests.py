@@ -0,0 +1,42 @@
+from datetime import date
+
+from click.testing import CliRunner
+import pytest
+import six
+
+from regparser.commands.benchmark_tree_formats import (
+    benchmark_tree_formats, memory_of)
+from regparser.history.versions import Version
+from regparser.index import entry
+from regparser.tree import packed
+from regparser.tree.struct import Node
+
+
+@pytest.mark.django_db
+def test_benchmark_tree_formats():
+    """Each format should be reported, using the last version's tree"""
+    for idx, version_id in enumerate(('v1', 'v2')):
+        entry.Version(12, 1000, version_id).write(Version(
+            version_id, date(2000, 1, idx + 1), date(2000, 1, idx + 1)))
+    entry.Tree(12, 1000, 'v2').write(Node(
+        text='text', label=['1000'],
+        children=[Node(text='child', label=['1000', '1'])]))
+
+    result = CliRunner().invoke(benchmark_tree_formats,
+                                ['12', '1000', '--repeat', '1'])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert [line.split()[0] for line in lines[1:]] == ['json', 'packed']
+
+    result = CliRunner().invoke(benchmark_tree_formats, ['12', '1001'])
+    assert result.exit_code != 0
+
+
+def test_memory_of():
+    """The decoded tree's memory should be measured, where possible"""
+    encoded = packed.encode(Node(text='text' * 100, label=['1000']))
+    memory = memory_of(packed.decode_full, encoded)
+    if six.PY2:     # no tracemalloc
+        assert memory is None
+    else:
+        assert memory >= 400
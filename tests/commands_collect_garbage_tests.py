@@ -0,0 +1,22 @@
+from click.testing import CliRunner
+import pytest
+
+from regparser.commands.collect_garbage import collect_garbage
+from regparser.index import entry
+from regparser.web.index.models import Blob
+
+
+@pytest.mark.django_db
+def test_collect_garbage():
+    """Only contents which are no longer referenced should be deleted"""
+    entry.Entry('a').write(b'original')
+    entry.Entry('b').write(b'shared')
+    entry.Entry('c').write(b'shared')
+    entry.Entry('a').write(b'replaced')
+    assert Blob.objects.count() == 3
+
+    result = CliRunner().invoke(collect_garbage)
+    assert result.exit_code == 0
+    assert Blob.objects.count() == 2
+    assert entry.Entry('a').read() == b'replaced'
+    assert entry.Entry('b').read() == b'shared'
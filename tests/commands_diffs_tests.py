@@ -1,14 +1,18 @@
 from contextlib import contextmanager
-from datetime import timedelta
+from datetime import date, timedelta
 from unittest import TestCase
 
 from click.testing import CliRunner
 from django.utils import timezone
+from mock import patch
 import pytest
 import six
 
-from regparser.commands.diffs import diffs
-from regparser.index import entry
+from regparser.commands.diffs import (
+    _diff_group_in_worker, _groups, builders, compute_diffs, diff_between,
+    diffs, version_pairs)
+from regparser.history.versions import Version
+from regparser.index import dependency, entry, executor
 from regparser.tree.struct import Node
 from regparser.web.index.models import Entry as DBEntry
 
@@ -58,3 +62,144 @@ class CommandsDiffsTests(TestCase):
             DBEntry.objects.filter(label_id=label_id).update(modified=new_time)
             self.cli.invoke(diffs, ['12', '1000'])
             self.assert_diff_keys('v1', 'v2', ['1000'])
+
+    def test_pairs(self):
+        """Only the requested pairs should be built, in version order"""
+        with self.integration_setup():
+            (self.tree_dir / 'v3').write(Node(text='V3', label=['1000']))
+            for day, version_id in enumerate(('v1', 'v2', 'v3'), start=1):
+                entry.Version('12', '1000', version_id).write(Version(
+                    version_id, date(2001, 1, day), date(2001, 1, day)))
+
+            result = self.cli.invoke(diffs, ['12', '1000', '--pairs',
+                                             'adjacent'])
+            self.assertEqual(result.exit_code, 0)
+            six.assertCountEqual(
+                self,
+                [d.path[-2:] for d in entry.Diff('12', '1000').sub_entries()],
+                [('v1', 'v2'), ('v2', 'v3')])
+
+            self.cli.invoke(diffs, ['12', '1000', '--pairs', 'adjacent',
+                                    '--pairs', 'latest'])
+            self.assertTrue((self.diff_dir / 'v1' / 'v3').exists())
+            self.assertFalse((self.diff_dir / 'v3' / 'v1').exists())
+
+    def test_diff_between(self):
+        """Diffs should be computed (and stored) on demand, but not
+        recomputed while up to date"""
+        with self.integration_setup():
+            self.assertEqual(list(diff_between('12', '1000', 'v1', 'v2')),
+                             ['1000'])
+            self.assert_diff_keys('v1', 'v2', ['1000'])
+
+            (self.diff_dir / 'v1' / 'v2').write({'update': 'update'})
+            self.assertEqual(diff_between('12', '1000', 'v1', 'v2'),
+                             {'update': 'update'})
+
+            (self.tree_dir / 'v2').write(Node(text='V2', label=['1000']))
+            self.assertEqual(list(diff_between('12', '1000', 'v1', 'v2')),
+                             ['1000'])
+
+    def test_compute_diffs(self):
+        """Pairs should be grouped, reading each tree once"""
+        with self.integration_setup():
+            tree_dir = entry.FrozenTree('12', '1000')
+            pairs = [('v1', 'v1'), ('v2', 'v1'), ('v1', 'v2')]
+            with patch.object(entry.FrozenTree, 'read',
+                              autospec=True,
+                              side_effect=entry.FrozenTree.read) as read:
+                results = list(compute_diffs(tree_dir, pairs))
+            self.assertEqual(read.call_count, 2)
+            self.assertEqual([(lhs, rhs) for lhs, rhs, _ in results], pairs)
+            self.assertEqual([list(diff) for _, _, diff in results],
+                             [[], ['1000'], ['1000']])
+
+    def test_builders(self):
+        """Diffs should be built in groups, reading each tree once even when
+        the groups are built separately"""
+        with self.integration_setup():
+            deps = dependency.Graph()
+            result = builders(deps, '12', '1000', ['v1', 'v2'])
+            self.assertEqual([path.path[-2:] for path in result], [
+                ('v1', 'v1'), ('v1', 'v2'), ('v2', 'v1'), ('v2', 'v2')])
+            self.assertEqual(len(set(id(b) for b in result.values())), 2)
+
+            with patch.object(entry.FrozenTree, 'read',
+                              autospec=True,
+                              side_effect=entry.FrozenTree.read) as read:
+                executor.build_stale(deps, result)
+            self.assertEqual(read.call_count, 2)
+            self.assert_diff_keys('v1', 'v1', [])
+            self.assert_diff_keys('v1', 'v2', ['1000'])
+            self.assert_diff_keys('v2', 'v1', ['1000'])
+
+            # Rewritten trees are re-read
+            (self.tree_dir / 'v2').write(Node(text='V2', label=['1000']))
+            deps.rebuild()
+            with patch.object(entry.FrozenTree, 'read',
+                              autospec=True,
+                              side_effect=entry.FrozenTree.read) as read:
+                executor.build_stale(deps, result)
+            self.assertEqual([call[0][0].path[-1]
+                              for call in read.call_args_list], ['v1', 'v2'])
+
+    def test_failure_keeps_diffs(self):
+        """Diffs computed before a failure should still be written"""
+        def partial_results(tree_dir, pairs, jobs):
+            yield 'v1', 'v2', {'1000': 'changed'}
+            raise executor.BuildFailed(tree_dir / 'v2', 'Boom')
+
+        with self.integration_setup(), \
+                patch('regparser.commands.diffs.compute_diffs',
+                      partial_results):
+            result = self.cli.invoke(diffs, ['12', '1000'])
+            self.assertIsInstance(result.exception, executor.BuildFailed)
+            self.assert_diff_keys('v1', 'v2', ['1000'])
+
+    def test_jobs(self):
+        """Diffs computed in worker processes should match"""
+        with self.integration_setup():
+            result = self.cli.invoke(diffs, ['12', '1000', '--jobs', '2'])
+            self.assertEqual(result.exit_code, 0)
+            self.assert_diff_keys('v1', 'v1', [])
+            self.assert_diff_keys('v1', 'v2', ['1000'])
+            self.assert_diff_keys('v2', 'v1', ['1000'])
+
+
+def test_diff_group_in_worker_errors():
+    """Exceptions in workers should be sent back as text"""
+    with patch('regparser.commands.diffs.diff_group') as diff_group:
+        diff_group.side_effect = ValueError('Bad tree')
+        results, (lhs_id, details) = _diff_group_in_worker(
+            (entry.FrozenTree('12', '1000'), [('v1', 'v2')], frozenset()))
+    assert results is None
+    assert lhs_id == 'v1'
+    assert 'Bad tree' in details
+
+
+def test_groups():
+    """Each group's trees should be released once no later group needs
+    them, even when diffing every pair"""
+    groups = _groups(version_pairs(['v1', 'v2', 'v3']))
+    assert [(sorted(pairs), sorted(needed_later))
+            for pairs, needed_later in groups] == [
+        ([('v1', 'v1'), ('v1', 'v2'), ('v1', 'v3'), ('v2', 'v1'),
+          ('v3', 'v1')], ['v2', 'v3']),
+        ([('v2', 'v2'), ('v2', 'v3'), ('v3', 'v2')], ['v3']),
+        ([('v3', 'v3')], [])]
+    assert _groups([('v1', 'v2'), ('v2', 'v3')]) == [
+        ([('v1', 'v2')], {'v2', 'v3'}), ([('v2', 'v3')], set())]
+
+
+def test_version_pairs():
+    version_ids = ['v1', 'v2', 'v3']
+    assert version_pairs(version_ids, ['adjacent']) == [
+        ('v1', 'v2'), ('v2', 'v3')]
+    assert version_pairs(version_ids, ['latest']) == [
+        ('v1', 'v3'), ('v2', 'v3')]
+    assert version_pairs(version_ids, ['adjacent', 'latest']) == [
+        ('v1', 'v2'), ('v2', 'v3'), ('v1', 'v3')]
+    assert len(version_pairs(version_ids)) == 9
+    assert version_pairs([], ['adjacent', 'latest']) == []
+    with pytest.raises(ValueError):
+        version_pairs(version_ids, ['other'])
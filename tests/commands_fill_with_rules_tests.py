@@ -103,3 +103,79 @@ class CommandsFillWithRulesTests(TestCase):
             self.assertEqual(changes, {
                 "1000-2-b": ["2b changes"], "1000-2-c": ["2c changes"],
                 "1000-4-a": ["4a changes"]})
+
+    @patch('regparser.commands.fill_with_rules.compile_version')
+    def test_process_chain(self, compile_version):
+        """Trees should be built in order, each from its in-memory parent.
+        Trees which aren't stale are read rather than rebuilt"""
+        compiled = []
+
+        def compile_tree(prev_tree, version_id):
+            compiled.append(Node(prev_tree.text + version_id))
+            return compiled[-1]
+        compile_version.side_effect = compile_tree
+        with self.cli.isolated_filesystem():
+            versions = [Version(str(i)*3, date(2001, i, i), date(2002, i, i))
+                        for i in range(1, 5)]
+            tree_dir = entry.Tree('12', '1000')
+            vers_dir = entry.Version('12', '1000')
+            for version in versions:
+                (vers_dir / version.identifier).write(version)
+                entry.Entry('notice_xml', version.identifier).write(b'')
+            (tree_dir / '111').write(Node('1'))
+            versions_with_parents = list(zip(versions,
+                                             Version.parents_of(versions)))
+            deps = fill_with_rules.dependencies(
+                tree_dir, vers_dir, versions_with_parents)
+
+            built = fill_with_rules.process_chain(
+                deps, tree_dir, versions_with_parents)
+            self.assertEqual(built, ['222', '333', '444'])
+            self.assertEqual((tree_dir / '444').read().text, '1222333444')
+            # Each parent was passed along without being read back
+            parents = [args[0] for args, _ in compile_version.call_args_list]
+            self.assertEqual(parents[0].text, '1')
+            self.assertIs(parents[1], compiled[0])
+            self.assertIs(parents[2], compiled[1])
+
+            # Nothing is stale, so nothing's rebuilt
+            deps = fill_with_rules.dependencies(
+                tree_dir, vers_dir, versions_with_parents)
+            self.assertEqual(fill_with_rules.process_chain(
+                deps, tree_dir, versions_with_parents), [])
+
+            # Only trees derived from an updated one are rebuilt; the first
+            # of those reads its parent from the index
+            (vers_dir / '333').write(versions[2])
+            deps = dependency.Graph()
+            self.assertEqual(fill_with_rules.process_chain(
+                deps, tree_dir, versions_with_parents), ['333', '444'])
+            self.assertEqual(compile_version.call_args_list[3][0][0].text,
+                             '1222')
+            self.assertIsNot(compile_version.call_args_list[3][0][0],
+                             compiled[0])
+
+    @patch('regparser.commands.fill_with_rules.compile_version')
+    def test_process_chain_missing(self, compile_version):
+        """Trees built before a missing dependency is found should be kept"""
+        compile_version.side_effect = lambda prev_tree, version_id: Node(
+            prev_tree.text + version_id)
+        with self.cli.isolated_filesystem():
+            versions = [Version(str(i)*3, date(2001, i, i), date(2002, i, i))
+                        for i in range(1, 4)]
+            tree_dir = entry.Tree('12', '1000')
+            vers_dir = entry.Version('12', '1000')
+            for version in versions:
+                (vers_dir / version.identifier).write(version)
+            entry.Entry('notice_xml', '222').write(b'')
+            (tree_dir / '111').write(Node('1'))
+            versions_with_parents = list(zip(versions,
+                                             Version.parents_of(versions)))
+            deps = fill_with_rules.dependencies(
+                tree_dir, vers_dir, versions_with_parents)
+
+            with self.assertRaises(dependency.Missing):
+                fill_with_rules.process_chain(
+                    deps, tree_dir, versions_with_parents)
+            self.assertEqual((tree_dir / '222').read().text, '1222')
+            self.assertFalse((tree_dir / '333').exists())
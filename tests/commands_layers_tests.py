@@ -8,7 +8,7 @@ import six
 
 from regparser.commands import layers
 from regparser.history.versions import Version
-from regparser.index import dependency, entry
+from regparser.index import dependency, entry, executor
 from regparser.tree.struct import Node
 
 
@@ -69,3 +69,21 @@ class CommandsLayersTests(TestCase):
 
             self.assertTrue(
                 entry.Layer.preamble('111_222', 'graphics').exists())
+
+    def test_cfr_builders(self):
+        """Each tree's layers should be built together"""
+        configured_layers = {'cfr': {'keyterms': None, 'other': None}}
+        with self.cli.isolated_filesystem(), patch.dict(
+                layers.LAYER_CLASSES, configured_layers):
+            deps = dependency.Graph()
+            builders = layers.cfr_builders(
+                deps, [entry.Tree(12, 1000, 'v1'), entry.Tree(12, 1000, 'v2')])
+            by_label = {str(key): builder
+                        for key, builder in builders.items()}
+            self.assertEqual(len(by_label), 4)
+            for version_id in ('v1', 'v2'):
+                layer_dir = entry.Layer.cfr(12, 1000, version_id)
+                keyterms = by_label[str(layer_dir / 'keyterms')]
+                self.assertIsInstance(keyterms, executor.Batch)
+                self.assertIs(keyterms, by_label[str(layer_dir / 'other')])
+                self.assertTrue(deps.is_stale(layer_dir / 'keyterms'))
@@ -0,0 +1,41 @@
+from datetime import date
+import os
+
+from click.testing import CliRunner
+from mock import patch
+import pytest
+
+from regparser.commands import pipeline
+from regparser.history.versions import Version
+from regparser.index import entry
+from regparser.tree.struct import Node
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_diff_pairs(jobs):
+    """Diffs which weren't precomputed should still be written"""
+    with CliRunner().isolated_filesystem(), \
+            patch.object(pipeline, 'versions'), \
+            patch.object(pipeline, 'annual_editions'), \
+            patch.object(pipeline, 'fill_with_rules'), \
+            patch.object(pipeline, 'layers'), \
+            patch.object(pipeline, 'build_in_parallel') as build_in_parallel:
+        version_ids = ('v1', 'v2', 'v3')
+        for day, version_id in enumerate(version_ids, start=1):
+            entry.Version('12', '1000', version_id).write(Version(
+                version_id, date(2001, 1, day), date(2001, 1, day)))
+            entry.Tree('12', '1000', version_id).write(
+                Node(version_id, label=['1000']))
+
+        result = CliRunner().invoke(pipeline.pipeline, [
+            '12', '1000', 'output', '--diff-pairs', 'adjacent', '--jobs',
+            jobs])
+        assert result.exit_code == 0
+        if jobs == '2':
+            assert build_in_parallel.call_args[1]['diff_pairs'] == (
+                'adjacent',)
+        for lhs_id in version_ids:
+            for rhs_id in version_ids:
+                assert os.path.isfile(os.path.join(
+                    'output', 'diff', '1000', lhs_id, rhs_id))
@@ -0,0 +1,35 @@
+from click.testing import CliRunner
+import pytest
+
+from regparser.commands.recompress import recompress
+from regparser.index import entry
+from regparser.web.index.models import Entry as DBEntry
+
+
+@pytest.mark.django_db
+def test_recompress(settings):
+    """Entries should be re-encoded without changing their contents or
+    modification times"""
+    settings.EREGS_INDEX_CODEC = ''
+    plain = entry.Entry('plain')
+    plain.write(b'content' * 100)
+    settings.EREGS_INDEX_CODEC = 'zlib'
+    compressed = entry.Entry('compressed')
+    compressed.write(b'other' * 100)
+    modified = DBEntry.objects.get(label=str(plain)).modified
+
+    result = CliRunner().invoke(recompress, ['--codec', 'zlib'])
+    assert result.exit_code == 0
+
+    db_entry = DBEntry.objects.get(label=str(plain))
+    assert db_entry.blob.codec == 'zlib'
+    assert len(db_entry.blob.contents) < 100
+    assert db_entry.modified == modified
+    assert plain.read() == b'content' * 100
+    assert compressed.read() == b'other' * 100
+
+    result = CliRunner().invoke(recompress, ['--codec', ''])
+    assert result.exit_code == 0
+    assert bytes(DBEntry.objects.get(label=str(plain)).blob.contents) == (
+        b'content' * 100)
+    assert compressed.read() == b'other' * 100
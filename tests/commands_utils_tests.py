@@ -0,0 +1,23 @@
+import pytest
+
+from regparser.commands import utils
+from regparser.index import entry
+
+
+@pytest.mark.django_db
+def test_relevant_paths():
+    """Paths should be filtered by CFR title and part"""
+    for title, part in ((11, 100), (11, 1000), (12, 100), (12, 1000)):
+        entry.Entry('tree', title, part, 'v1').write(b'')
+        entry.Entry('tree', title, part, 'v2').write(b'')
+
+    def paths(title, part):
+        return [sub_entry.path for sub_entry
+                in utils.relevant_paths(entry.Tree(), title, part)]
+
+    assert paths(11, 100) == [('11', '100', 'v1'), ('11', '100', 'v2')]
+    assert paths(12, None) == [('12', '100', 'v1'), ('12', '100', 'v2'),
+                               ('12', '1000', 'v1'), ('12', '1000', 'v2')]
+    assert paths(None, 1000) == [('11', '1000', 'v1'), ('11', '1000', 'v2'),
+                                 ('12', '1000', 'v1'), ('12', '1000', 'v2')]
+    assert len(paths(None, None)) == 8
@@ -160,6 +160,19 @@ class CommandsWriteToTests(TestCase):
             self.assert_file_exists('notice', 'v0')
             self.assert_file_exists('notice', 'v1')
 
+    def test_compute_diffs(self):
+        """Diffs which weren't precomputed can be computed when writing"""
+        with self.integration() as cli:
+            cli.invoke(write_to, [self.tmpdir, '--cfr_title', '12',
+                                  '--cfr_part', '1000', '--compute-diffs'])
+
+            for lhs_id in ('v2', 'v3', 'v4'):
+                for rhs_id in ('v2', 'v3', 'v4'):
+                    self.assert_file_exists('diff', '1000', lhs_id, rhs_id)
+            self.assertTrue(entry.Diff('12', '1000', 'v3', 'v4').exists())
+            # Only trees are considered
+            self.assert_no_file('diff', '1000', 'v1', 'v2')
+
     @patch('regparser.commands.write_to.add_footnotes')
     @patch('regparser.commands.write_to.process_sxs')
     def test_transform_notice(self, process_sxs, add_footnotes):
@@ -3,12 +3,17 @@ from datetime import timedelta
 from unittest import TestCase
 
 from click.testing import CliRunner
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from mock import patch
+import networkx
 import pytest
 import six
 
 from regparser.index import dependency, entry
-from regparser.web.index.models import Entry as DBEntry
+from regparser.web.index.models import Dependency, Entry as DBEntry
 
 
 @pytest.mark.django_db
@@ -131,3 +136,153 @@ class DependencyGraphTests(TestCase):
             self._touch(c, 3000)
             # C and D have been updated, but C's been updated after D
             self.assert_rebuilt_state(graph, path, a='', b='', c='', d='c')
+
+    def test_add_is_incremental(self):
+        """Adding a dependency should only write the new edge, regardless of
+        how many dependencies already exist"""
+        with self.dependency_graph() as dgraph:
+            with CaptureQueriesContext(connection) as small_graph:
+                dgraph.add(self.depender, self.dependency / 'first')
+            for i in range(20):
+                dgraph.add(self.depender, self.dependency / i)
+            with CaptureQueriesContext(connection) as large_graph:
+                dgraph.add(self.depender, self.dependency / 'last')
+            self.assertEqual(len(small_graph), len(large_graph))
+            self.assertEqual(Dependency.objects.count(), 22)
+
+            # Re-adding an existing dependency is a no-op
+            with CaptureQueriesContext(connection) as queries:
+                dgraph.add(self.depender, self.dependency / 'last')
+            self.assertEqual(len(queries), 0)
+
+    def test_batch(self):
+        """Changes made within a batch aren't written until the batch ends"""
+        with self.dependency_graph() as dgraph:
+            with dgraph.batch():
+                dgraph.add(self.depender, self.dependency / 1)
+                dgraph.add(self.depender, self.dependency / 2)
+                self.assertEqual(Dependency.objects.count(), 0)
+                # Staleness info is still available
+                self.assertTrue(dgraph.is_stale(self.depender))
+            self.assertEqual(Dependency.objects.count(), 2)
+            six.assertCountEqual(
+                self,
+                dependency.Graph().dependencies(str(self.depender)),
+                [str(self.dependency / 1), str(self.dependency / 2)])
+
+    def test_clear_for(self):
+        """All of an entry's dependencies should be removed, in memory and in
+        the db"""
+        with self.dependency_graph() as dgraph:
+            other = self.depender / 'other'
+            dgraph.add(self.depender, self.dependency / 1)
+            dgraph.add(self.depender, self.dependency / 2)
+            dgraph.add(other, self.dependency / 1)
+
+            dgraph.clear_for(self.depender)
+            self.assertEqual(dgraph.dependencies(str(self.depender)), [])
+            self.assertEqual(
+                dependency.Graph().dependencies(str(self.depender)), [])
+            self.assertEqual(
+                dependency.Graph().dependencies(str(other)),
+                [str(self.dependency / 1)])
+
+    def test_rebuild_single_query(self):
+        """Modification times should be retrieved all at once"""
+        with CliRunner().isolated_filesystem():
+            graph = dependency.Graph()
+            path = entry.Entry('path')
+            for i in range(10):
+                graph.add(path / 'out' / i, path / 'in' / i)
+                (path / 'in' / i).write(b'content')
+            with CaptureQueriesContext(connection) as queries:
+                graph.rebuild()
+            self.assertEqual(len(queries), 1)
+
+    def test_rebuild_partial(self):
+        """Only nodes downstream of a modification should be recalculated"""
+        with CliRunner().isolated_filesystem():
+            graph = dependency.Graph()
+            path = entry.Entry('path')
+            a, b, c, d = [path / char for char in 'abcd']
+            # A -> B, C -> D
+            graph.add(b, a)
+            graph.add(d, c)
+            for node in (a, b, c, d):
+                node.write(b'content')
+            graph.rebuild()
+
+            self._touch(c, 1000)
+            with patch.object(graph, 'dependencies',
+                              wraps=graph.dependencies) as dependencies, \
+                    patch('regparser.index.dependency.networkx.'
+                          'topological_sort',
+                          wraps=networkx.topological_sort) as sort:
+                graph.rebuild()
+            # Only the changed region is sorted
+            six.assertCountEqual(self, sort.call_args[0][0].nodes(),
+                                 [str(c), str(d)])
+            six.assertCountEqual(
+                self, [call[0][0] for call in dependencies.call_args_list],
+                [str(c), str(d)])
+            self.assertFalse(graph.is_stale(b))
+            self.assertTrue(graph.is_stale(d))
+
+    def test_rebuild_labels(self):
+        """When told which entries were written, only their modification
+        times should be retrieved"""
+        with CliRunner().isolated_filesystem():
+            graph = dependency.Graph()
+            path = entry.Entry('path')
+            a, b, c, d = [path / char for char in 'abcd']
+            # A -> B, C -> D
+            graph.add(b, a)
+            graph.add(d, c)
+            for node in (a, b, c, d):
+                node.write(b'content')
+            graph.rebuild()
+
+            self._touch(c, 1000)
+            with CaptureQueriesContext(connection) as queries:
+                graph.rebuild([c])
+            self.assertEqual(len(queries), 1)
+            self.assertIn(str(c), queries[0]['sql'])
+            self.assertNotIn(str(a), queries[0]['sql'])
+            self.assertFalse(graph.is_stale(b))
+            self.assertTrue(graph.is_stale(d))
+
+    def test_rebuild_labels_first(self):
+        """The first rebuild should scan everything, even if labels are
+        provided"""
+        with self.dependency_graph() as dgraph:
+            self.dependency.write(b'value')
+            self.depender.write(b'value2')
+            dgraph.add(self.depender, self.dependency)
+            graph = dependency.Graph()
+            graph.rebuild([self.depender])
+            self.assertFalse(graph.is_stale(self.dependency))
+            self.assertFalse(graph.is_stale(self.depender))
+
+    def test_digest_staleness(self):
+        """When configured, rewriting a dependency with identical contents
+        shouldn't cause its dependers to be stale"""
+        with self.dependency_graph() as dgraph, \
+                override_settings(EREGS_DIGEST_STALENESS=True):
+            self.dependency.write(b'value')
+            self.depender.write(b'value2')
+            dgraph.add(self.depender, self.dependency)
+            self.assertFalse(dgraph.is_stale(self.depender))
+
+            self.dependency.write(b'value')
+            dgraph.rebuild()
+            self.assertFalse(dgraph.is_stale(self.depender))
+
+            self.dependency.write(b'new value')
+            dgraph.rebuild()
+            self.assertTrue(dgraph.is_stale(self.depender))
+
+            # Rebuilding the depender, even with the same contents, makes it
+            # up to date
+            self.depender.write(b'value2')
+            dgraph.rebuild()
+            self.assertFalse(dgraph.is_stale(self.depender))
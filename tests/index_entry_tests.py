@@ -1,9 +1,19 @@
 from datetime import date
+import io
+import json
+import os
+import shutil
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mock import patch
 import pytest
+import requests
 
 from regparser.history.versions import Version
 from regparser.index import entry
+from regparser.tree.struct import Node
+from regparser.web.index.models import Blob, Entry as DBEntry
 
 
 @pytest.mark.django_db
@@ -23,3 +33,262 @@ def test_iterator():
     actual = [child.path[-1] for child in path.sub_entries()]
 
     assert ['2222', '3333', '1111'] == actual
+
+
+@pytest.mark.django_db
+def test_write_digest():
+    """Rewriting identical contents should update the modification time, but
+    not the time the contents changed"""
+    path = entry.Entry('some', 'path')
+    path.write(b'content')
+    original = DBEntry.objects.get(label=str(path))
+
+    path.write(b'content')
+    rewritten = DBEntry.objects.get(label=str(path))
+    assert rewritten.blob_id == original.blob_id
+    assert rewritten.changed == original.changed
+    assert rewritten.modified > original.modified
+
+    path.write(b'other content')
+    changed = DBEntry.objects.get(label=str(path))
+    assert changed.blob_id != original.blob_id
+    assert changed.changed > original.changed
+    assert path.read() == b'other content'
+
+
+@pytest.mark.django_db
+def test_write_shared_contents():
+    """Entries with identical contents should share their storage"""
+    entry.Entry('a').write(b'content')
+    entry.Entry('b').write(b'content')
+    entry.Entry('c').write(b'other')
+
+    assert Blob.objects.count() == 2
+    assert (DBEntry.objects.get(label=str(entry.Entry('a'))).blob_id ==
+            DBEntry.objects.get(label=str(entry.Entry('b'))).blob_id)
+    assert entry.Entry('b').read() == b'content'
+
+
+@pytest.mark.django_db
+def test_sub_entries():
+    """Only entries beneath the requested path should be returned, without
+    loading their contents"""
+    for path in ('a', 'a/1', 'a/2/b', 'ab/1', 'a0', 'a.1'):
+        entry.Entry(*path.split('/')).write(b'content')
+
+    with CaptureQueriesContext(connection) as queries:
+        sub_entries = list(entry.Entry('a').sub_entries())
+    assert [sub.path for sub in sub_entries] == [
+        ('a', '1'), ('a', '2', 'b')]
+    assert 'contents' not in queries[0]['sql']
+    assert 'JOIN' not in queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_sub_entries_collation():
+    """Outside of SQLite, labels might not sort by codepoint, so the
+    filter shouldn't be a range"""
+    entry.Entry('a', '1').write(b'content')
+    with patch.object(entry.connection, 'vendor', 'postgresql'):
+        assert entry.Entry('a')._beneath('label__label') == {
+            'label__label__startswith': str(entry.Entry('a')) + os.sep}
+        assert [sub.path for sub in entry.Entry('a').sub_entries()] == [
+            ('a', '1')]
+        assert list(entry.Version('12', '1000').metadata()) == []
+
+
+@pytest.mark.django_db
+def test_version_metadata():
+    """Versions should be listed via their metadata, in one query, and
+    FinalVersion should skip proposals"""
+    path = entry.Version("12", "1000")
+    (path / '1111').write(Version('1111', effective=date(2004, 4, 4),
+                                  published=date(2004, 4, 4)))
+    (path / '2222').write(Version('2222', effective=None,
+                                  published=date(2003, 3, 3)))
+
+    with CaptureQueriesContext(connection) as queries:
+        actual = [child.path[-1] for child in path.sub_entries()]
+    assert ['2222', '1111'] == actual
+    assert len(queries) == 1
+
+    final_path = entry.FinalVersion("12", "1000")
+    assert ['1111'] == [child.path[-1] for child in final_path.sub_entries()]
+
+
+@pytest.mark.django_db
+def test_read_stream():
+    """The serialized form of an entry should be readable as a stream"""
+    path = entry.Layer('some', 'layer')
+    path.write({'key': ['value']})
+    assert path.read() == {'key': ['value']}
+    assert json.loads(path.read_stream().read().decode('utf-8')) == {
+        'key': ['value']}
+
+
+def test_read_stream_buffer():
+    """Buffers should be streamed without being copied"""
+    contents = bytearray(b'abcdef')
+    path = entry.Entry('some', 'entry')
+    with patch.object(entry.Entry, '_contents',
+                      return_value=memoryview(contents)):
+        stream = path.read_stream()
+    contents[0:1] = b'z'
+    assert stream.read(2) == b'zb'
+    buf = bytearray(2)
+    assert stream.readinto(buf) == 2
+    assert buf == b'cd'
+    assert stream.read() == b'ef'
+    assert stream.read() == b''
+    stream.seek(-3, os.SEEK_END)
+    assert (stream.tell(), stream.read()) == (3, b'def')
+    stream.seek(0)
+    out = io.BytesIO()
+    shutil.copyfileobj(stream, out)
+    assert out.getvalue() == b'zbcdef'
+
+    stream.seek(2)
+    request = requests.Request('POST', 'http://example.com/',
+                               data=stream).prepare()
+    assert request.headers['Content-Length'] == '4'
+
+
+@pytest.mark.django_db
+def test_compression(settings):
+    """Entries should be readable regardless of the codec they were written
+    with"""
+    path = entry.Layer('some', 'layer')
+    settings.EREGS_INDEX_CODEC = ''
+    path.write({'key': ['value']})
+    settings.EREGS_INDEX_CODEC = 'zlib'
+    assert path.read() == {'key': ['value']}
+
+    path.write({'key': ['other value']})
+    assert DBEntry.objects.get(label=str(path)).blob.codec == 'zlib'
+    assert path.read() == {'key': ['other value']}
+    assert json.loads(path.read_stream().read().decode('utf-8')) == {
+        'key': ['other value']}
+
+
+@pytest.mark.django_db
+def test_bulk_writer():
+    """Writes within a bulk_writer should be stored together at the end of
+    the block, with the same semantics as individual writes"""
+    entry.Entry('existing').write(b'content')
+    entry.Entry('unchanged').write(b'same')
+    original = DBEntry.objects.get(label=str(entry.Entry('unchanged')))
+    version_dir = entry.Version('12', '1000')
+
+    with entry.bulk_writer():
+        for i in range(5):
+            entry.Entry('new', i).write(b'content')
+        entry.Entry('existing').write(b'replaced')
+        entry.Entry('unchanged').write(b'same')
+        (version_dir / '1111').write(Version(
+            '1111', effective=None, published=date(2004, 4, 4)))
+        assert not entry.Entry('new', 0).exists()
+
+    assert [sub.path for sub in entry.Entry('new').sub_entries()] == [
+        ('new', str(i)) for i in range(5)]
+    assert entry.Entry('new', 3).read() == b'content'
+    assert entry.Entry('existing').read() == b'replaced'
+    unchanged = DBEntry.objects.get(label=str(entry.Entry('unchanged')))
+    assert unchanged.changed == original.changed
+    assert unchanged.modified > original.modified
+    assert [child.path[-1] for child in version_dir.sub_entries()] == [
+        '1111']
+
+
+@pytest.mark.django_db
+def test_bulk_writer_queries(monkeypatch):
+    """The number of queries shouldn't grow with the number of entries"""
+    monkeypatch.setattr(entry, 'BULK_WRITE_SIZE', 1000)
+    with CaptureQueriesContext(connection) as queries:
+        with entry.bulk_writer():
+            for i in range(50):
+                entry.Entry(i).write(str(i).encode('utf-8'))
+    assert len(queries) < 15
+    assert entry.Entry(42).read() == b'42'
+
+
+@pytest.mark.django_db
+def test_read_cache(settings):
+    """Deserialized entries should be cached (if configured), but not
+    returned once they've been rewritten"""
+    settings.EREGS_INDEX_CACHE_SIZE = 2
+    entry.read_cache.clear()
+    a, b, c = entry.Entry('a'), entry.Entry('b'), entry.Entry('c')
+    for path in (a, b, c):
+        path.write(b'content')
+
+    assert [a.read(), a.read(), b.read()] == [b'content'] * 3
+    assert (entry.read_cache.hits, entry.read_cache.misses) == (1, 2)
+
+    a.write(b'new')
+    assert a.read() == b'new'
+    assert (entry.read_cache.hits, entry.read_cache.misses) == (1, 3)
+
+    c.read()    # evicts b, the least recently used
+    b.read()
+    a.read()    # evicted when b was re-read
+    assert (entry.read_cache.hits, entry.read_cache.misses) == (1, 6)
+
+
+@pytest.mark.django_db
+def test_read_cache_mutable(settings):
+    """Mutable values shouldn't be shared between reads. Rather than copying
+    them, their contents are cached, so a hit only skips fetching (and
+    decompressing) the contents; immutable values are shared"""
+    settings.EREGS_INDEX_CACHE_SIZE = 10
+    settings.EREGS_INDEX_CODEC = 'zlib'
+    entry.read_cache.clear()
+    layer = entry.Layer('some', 'layer')
+    layer.write({'key': ['value']})
+    with patch.object(entry.Layer, '_contents', autospec=True,
+                      side_effect=entry.Layer._contents) as contents, \
+            patch.object(entry.Layer, 'deserialize', autospec=True,
+                         side_effect=entry.Layer.deserialize) as deserialize:
+        layer.read()['key'].append('modified')
+        assert layer.read() == {'key': ['value']}
+    assert contents.call_count == 1
+    assert deserialize.call_count == 2
+    assert entry.read_cache.hits == 1
+
+    tree = entry.FrozenTree('12', '1000', 'v1')
+    tree.write(Node(text='text', label=['1000']))
+    assert tree.read() is tree.read()
+    assert entry.read_cache.hits == 2
+
+
+@pytest.mark.django_db
+def test_tree_formats(settings):
+    """Trees should be readable regardless of the format they were written
+    in"""
+    tree = Node(text='text', label=['1000'],
+                children=[Node(text='child', label=['1000', '1'])])
+    json_path = entry.Tree('12', '1000', 'v1')
+    packed_path = entry.Tree('12', '1000', 'v2')
+    settings.EREGS_TREE_FORMAT = 'json'
+    json_path.write(tree)
+    settings.EREGS_TREE_FORMAT = 'packed'
+    packed_path.write(tree)
+
+    assert json_path.read_stream().read(1) == b'{'
+    assert packed_path.read_stream().read(1) != b'{'
+    assert json_path.read() == packed_path.read() == tree
+    assert (entry.FrozenTree('12', '1000', 'v1').read() ==
+            entry.FrozenTree('12', '1000', 'v2').read())
+
+
+@pytest.mark.django_db
+def test_read_lazy(settings):
+    """Subtrees can be read lazily from either format"""
+    tree = Node(text='text', label=['1000'],
+                children=[Node(text='child', label=['1000', '1'])])
+    for tree_format in ('json', 'packed'):
+        settings.EREGS_TREE_FORMAT = tree_format
+        path = entry.Tree('12', '1000', tree_format)
+        path.write(tree)
+        assert path.read_lazy(['1000-1', '1000-2']) == {
+            '1000-1': tree.children[0]}
+        assert path.read_lazy(['1000']) == {'1000': tree}
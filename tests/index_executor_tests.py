@@ -0,0 +1,171 @@
+from unittest import TestCase
+
+from click.testing import CliRunner
+from mock import call, patch
+import pytest
+import six
+
+from regparser.index import dependency, entry, executor
+
+
+def write_entry(path, log_path):
+    """Builder which writes to the index and records that it was called"""
+    path.write(b'content')
+    with open(log_path, 'a') as log:
+        log.write(str(path) + '\n')
+
+
+def log_only(path, log_path):
+    """Builder which only records that it was called. Suitable for use in
+    worker processes, as they don't share the test database"""
+    with open(log_path, 'a') as log:
+        log.write(str(path) + '\n')
+
+
+def write_entries(paths, log_path):
+    """Batch builder which writes each of the paths, logging them as one
+    call"""
+    for path in paths:
+        path.write(b'content')
+    with open(log_path, 'a') as log:
+        log.write(','.join(str(path) for path in paths) + '\n')
+
+
+def explode():
+    raise ValueError("Boom")
+
+
+@pytest.mark.django_db
+class BuildStaleTests(TestCase):
+    def setUp(self):
+        self.cli = CliRunner()
+        self.path = entry.Entry('path')
+
+    def logged(self):
+        with open('log.txt') as log:
+            return log.read().split()
+
+    def test_dependency_order(self):
+        """Entries should be built after the entries they depend on, and
+        only if stale"""
+        with self.cli.isolated_filesystem():
+            a, b, c, d = [self.path / char for char in 'abcd']
+            source = self.path / 'source'
+            source.write(b'content')
+            d.write(b'content')
+            deps = dependency.Graph()
+            # source -> A -> B -> C, source -> D
+            deps.add(a, source)
+            deps.add(b, a)
+            deps.add(c, b)
+            deps.add(d, source)
+
+            builders = {node: (write_entry, (node, 'log.txt'))
+                        for node in (c, b, a, d)}
+            executor.build_stale(deps, builders)
+            self.assertEqual(self.logged(), [str(a), str(b), str(c)])
+
+            # Nothing's stale the second time around
+            executor.build_stale(deps, builders)
+            self.assertEqual(self.logged(), [str(a), str(b), str(c)])
+
+    def test_rebuilds(self):
+        """The graph should be scanned once, then only updated with the
+        entries which were just built"""
+        with self.cli.isolated_filesystem():
+            a, b = self.path / 'a', self.path / 'b'
+            source = self.path / 'source'
+            source.write(b'content')
+            deps = dependency.Graph()
+            deps.add(a, source)
+            deps.add(b, a)
+
+            builders = {node: (write_entry, (node, 'log.txt'))
+                        for node in (a, b)}
+            with patch.object(deps, 'rebuild',
+                              wraps=deps.rebuild) as rebuild:
+                executor.build_stale(deps, builders)
+            self.assertEqual(rebuild.call_args_list,
+                             [call(), call([str(a)]), call([str(b)])])
+            self.assertFalse(deps.is_stale(b))
+
+    def test_batch(self):
+        """Entries sharing a Batch should be built with one call, once all of
+        their dependencies are ready, and only if stale"""
+        with self.cli.isolated_filesystem():
+            a, b, c, d = [self.path / char for char in 'abcd']
+            source = self.path / 'source'
+            source.write(b'content')
+            c.write(b'content')
+            deps = dependency.Graph()
+            # source -> A -> B, source -> C, A -> D
+            deps.add(a, source)
+            deps.add(b, a)
+            deps.add(c, source)
+            deps.add(d, a)
+
+            batch = executor.Batch(write_entries, ('log.txt',))
+            builders = {b: batch, c: batch, d: batch,
+                        a: (write_entry, (a, 'log.txt'))}
+            executor.build_stale(deps, builders)
+            logged = self.logged()
+            self.assertEqual(logged[0], str(a))
+            six.assertCountEqual(self, logged[1].split(','),
+                                 [str(b), str(d)])
+            self.assertEqual(len(logged), 2)
+
+    def test_missing_dependency(self):
+        """If a dependency isn't present and won't be built, we should get an
+        exception"""
+        with self.cli.isolated_filesystem():
+            target = self.path / 'a'
+            deps = dependency.Graph()
+            deps.add(target, self.path / 'source')
+            with self.assertRaises(dependency.Missing):
+                executor.build_stale(
+                    deps, {target: (write_entry, (target, 'log.txt'))})
+
+    def test_parallel(self):
+        """Builders can run in separate processes"""
+        with self.cli.isolated_filesystem():
+            source = self.path / 'source'
+            source.write(b'content')
+            deps = dependency.Graph()
+            targets = [self.path / i for i in range(5)]
+            for target in targets:
+                deps.add(target, source)
+
+            executor.build_stale(
+                deps, {target: (log_only, (target, 'log.txt'))
+                       for target in targets},
+                jobs=2)
+            self.assertEqual(sorted(self.logged()),
+                             sorted(str(target) for target in targets))
+
+    def test_parallel_failure(self):
+        """Errors within a worker should be reported"""
+        with self.cli.isolated_filesystem():
+            source = self.path / 'source'
+            source.write(b'content')
+            deps = dependency.Graph()
+            deps.add(self.path / 'a', source)
+            with self.assertRaises(executor.BuildFailed) as context:
+                executor.build_stale(
+                    deps, {self.path / 'a': (explode, ())}, jobs=2)
+            self.assertEqual(context.exception.key, str(self.path / 'a'))
+            self.assertIn('Boom', context.exception.details)
+
+    @pytest.mark.skipif(six.PY2, reason="error_callback requires python 3")
+    def test_parallel_unpicklable(self):
+        """Failures outside of the builder (e.g. when sending its arguments
+        to a worker) should also be reported"""
+        with self.cli.isolated_filesystem():
+            source = self.path / 'source'
+            source.write(b'content')
+            deps = dependency.Graph()
+            deps.add(self.path / 'a', source)
+            with self.assertRaises(executor.BuildFailed) as context:
+                executor.build_stale(
+                    deps, {self.path / 'a': (log_only, (lambda: None,))},
+                    jobs=2)
+            self.assertEqual(context.exception.key, str(self.path / 'a'))
@@ -0,0 +1,116 @@
+import os
+
+from click.testing import CliRunner
+from mock import patch
+import pytest
+
+from regparser.commands.collect_garbage import collect_garbage
+from regparser.commands.recompress import recompress
+from regparser.index import entry, storage
+from regparser.notice.xml import NoticeXML
+from regparser.web.index.models import Blob
+
+
+@pytest.fixture
+def fs_storage(settings, tmpdir):
+    settings.EREGS_INDEX_STORAGE = 'fs'
+    settings.EREGS_INDEX_BLOB_DIR = str(tmpdir.join('blobs'))
+    return settings
+
+
+def stored_files(settings):
+    return [os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(settings.EREGS_INDEX_BLOB_DIR)
+            for filename in filenames]
+
+
+@pytest.mark.django_db
+def test_fs_round_trip(fs_storage):
+    """Contents should be written to files rather than the database, and
+    read back"""
+    fs_storage.EREGS_INDEX_CODEC = 'zlib'
+    path = entry.Layer('some', 'layer')
+    path.write({'key': ['value']})
+    entry.Entry('empty').write(b'')
+    with entry.bulk_writer():
+        entry.Entry('bulk').write(b'content')
+
+    assert path.read() == {'key': ['value']}
+    assert entry.Entry('empty').read() == b''
+    assert entry.Entry('bulk').read() == b'content'
+    assert entry.Entry('bulk').read_stream().read() == b'content'
+    assert set(Blob.objects.values_list('storage', flat=True)) == {'fs'}
+    assert bytes(Blob.objects.get(entries__label=str(entry.Entry('bulk')))
+                 .contents) == b''
+    assert len(stored_files(fs_storage)) == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('py2', [False, True])
+def test_fs_raw_contents(fs_storage, py2):
+    """Uncompressed contents should be readable as bytes (on Python 2, mmap
+    objects can't be converted) and survive being moved into the db"""
+    fs_storage.EREGS_INDEX_CODEC = ''
+    notice = entry.Notice('2016-12345')
+    with patch.object(storage.six, 'PY2', py2):
+        notice.write(NoticeXML(b'<ROOT><P>Content</P></ROOT>'))
+        entry.Entry('raw').write(b'content')
+
+        assert notice.read().xml.findtext('P') == 'Content'
+        assert entry.Entry('raw').read() == b'content'
+        assert entry.Entry('raw').read_stream().read() == b'content'
+
+        result = CliRunner().invoke(recompress, ['--storage', 'db'])
+        assert result.exit_code == 0
+        assert stored_files(fs_storage) == []
+        assert set(Blob.objects.values_list('storage', flat=True)) == {'db'}
+        assert entry.Entry('raw').read() == b'content'
+        assert notice.read().xml.findtext('P') == 'Content'
+
+
+@pytest.mark.django_db
+def test_recompress_checks_digest(fs_storage):
+    """If the contents read don't match, the only copy shouldn't be
+    replaced or deleted"""
+    entry.Entry('raw').write(b'content')
+    with patch.object(storage, 'read', return_value=b'<mmap object>'):
+        result = CliRunner().invoke(recompress, ['--storage', 'db'])
+    assert result.exit_code != 0
+    assert Blob.objects.get().storage == 'fs'
+    assert len(stored_files(fs_storage)) == 1
+    assert entry.Entry('raw').read() == b'content'
+
+
+@pytest.mark.django_db
+def test_unknown_storage(settings):
+    settings.EREGS_INDEX_STORAGE = 'tape'
+    with pytest.raises(ValueError):
+        entry.Entry('path').write(b'content')
+
+
+@pytest.mark.django_db
+def test_move_and_collect(fs_storage):
+    """Contents can be moved between backends, and files are removed once
+    they're no longer needed"""
+    fs_storage.EREGS_INDEX_STORAGE = 'db'
+    entry.Entry('path').write(b'content')
+
+    result = CliRunner().invoke(recompress, ['--storage', 'fs'])
+    assert result.exit_code == 0
+    assert Blob.objects.get().storage == 'fs'
+    assert len(stored_files(fs_storage)) == 1
+    assert entry.Entry('path').read() == b'content'
+
+    result = CliRunner().invoke(recompress, ['--storage', 'fs',
+                                             '--codec', 'zlib'])
+    assert result.exit_code == 0
+    assert [f.endswith('.zlib') for f in stored_files(fs_storage)] == [True]
+    assert entry.Entry('path').read() == b'content'
+
+    fs_storage.EREGS_INDEX_STORAGE = 'fs'
+    entry.Entry('path').write(b'other')
+    assert len(stored_files(fs_storage)) == 2
+    result = CliRunner().invoke(collect_garbage)
+    assert result.exit_code == 0
+    assert len(stored_files(fs_storage)) == 1
+    assert entry.Entry('path').read() == b'other'
@@ -156,3 +156,37 @@ class LayerSectionBySectionTest(TestCase):
         }
         s = SectionBySection(None, notices=[notice])
         self.assertEqual(None, s.process(Node(label=['100', '22'])))
+
+    def test_build_for(self):
+        """Building from only the referenced nodes should match building
+        from the whole tree"""
+        notice = {
+            "document_number": "111-22",
+            "fr_volume": 22,
+            "cfr_part": "100",
+            "publication_date": "2010-10-10",
+            "section_by_section": [{
+                "title": "",
+                "labels": ["100-22"],
+                "paragraphs": ["AAA"],
+                "page": 7676,
+                "children": [{
+                    "title": "",
+                    "labels": ["100-22-a", "100-23"],
+                    "paragraphs": ["BBB"],
+                    "page": 7677,
+                    "children": []
+                }]
+            }]
+        }
+        tree = Node(label=['100'], children=[
+            Node(label=['100', '22'], children=[
+                Node(label=['100', '22', 'a']),
+                Node(label=['100', '22', 'b'])])])
+        s = SectionBySection(tree, notices=[notice])
+        self.assertEqual(s.referenced_labels(),
+                         {'100-22', '100-22-a', '100-23'})
+        nodes = [tree.children[0], tree.children[0].children[0]]
+        self.assertEqual(
+            SectionBySection(None, notices=[notice]).build_for(nodes),
+            s.build())
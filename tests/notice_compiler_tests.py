@@ -3,7 +3,8 @@ from random import randint
 from unittest import TestCase
 
 from regparser.notice import compiler
-from regparser.tree.struct import Node, find
+from regparser.tree.struct import (
+    Node, NodeEncoder, find, find_parent, walk)
 
 
 class CompilerTests(TestCase):
@@ -951,3 +952,68 @@ class CompilerTests(TestCase):
         sect5, sect7 = find(tree.tree, '111-5'), find(tree.tree, '111-7')
         self.assertEqual([sub_b], tree.tree.children)
         self.assertEqual([sect5, sect7], sub_b.children)
+
+    def assert_index_consistent(self, reg_tree):
+        """The label indexes should match what we'd find by searching"""
+        nodes = walk(reg_tree.tree, lambda node: node)
+        self.assertEqual(set(reg_tree._by_label),
+                         set(node.label_id() for node in nodes))
+        self.assertEqual(len(reg_tree._parents), len(nodes))
+        for node in nodes:
+            label_id = node.label_id()
+            self.assertIs(reg_tree._find(label_id),
+                          find(reg_tree.tree, label_id))
+            self.assertIs(reg_tree._find_parent(label_id),
+                          find_parent(reg_tree.tree, label_id))
+
+    def test_label_index(self):
+        """The label indexes should be kept up to date as the tree is
+        modified"""
+        reg_tree = compiler.RegulationTree(self.tree_with_paragraphs())
+        self.assert_index_consistent(reg_tree)
+
+        reg_tree.move('205-2-a', ['205', '2', 'c'])
+        self.assert_index_consistent(reg_tree)
+        reg_tree.add_node(Node('n3', label=['205', '3']))
+        reg_tree.add_node(Node('n3a', label=['205', '3', 'a']))
+        self.assert_index_consistent(reg_tree)
+        reg_tree.replace_node_and_subtree(Node('new n2', label=['205', '2']))
+        self.assertEqual([], reg_tree.find_node('205-2').children)
+        self.assert_index_consistent(reg_tree)
+        reg_tree.reserve('205-4', Node('[Reserved]', label=['205', '4']))
+        reg_tree.insert_in_order(Node('n2b', label=['205', '2', 'b']))
+        reg_tree.delete('205-1')
+        self.assert_index_consistent(reg_tree)
+        reg_tree.move_to_subpart('205-3', ['205', 'Subpart', 'B'])
+        self.assert_index_consistent(reg_tree)
+        self.assertIsNone(reg_tree.find_node('205-1'))
+        self.assertEqual(['205', 'Subpart', 'B'],
+                         reg_tree.get_parent(Node(label=['205', '3'])).label)
+
+        # Duplicate labels should still find the first
+        reg_tree.add_node(Node('dupe', label=['205', '2']))
+        self.assertEqual(2, len(reg_tree._by_label['205-2']))
+        self.assert_index_consistent(reg_tree)
+        reg_tree.delete('205-2')
+        self.assert_index_consistent(reg_tree)
+
+    def test_copy_on_write(self):
+        """The previous tree should not be modified; unchanged nodes should be
+        shared with it"""
+        prev_tree = self.tree_with_paragraphs()
+        prev_json = NodeEncoder(sort_keys=True).encode(prev_tree)
+        changes = {
+            '205-2-a': [{'action': 'PUT', 'field': '[text]',
+                         'node': {'text': 'new text'}}],
+            '205-2-b': [{'action': 'MOVE', 'destination': ['205', '2', 'c']}],
+            '205-4': [{'action': 'DELETE'}]}
+
+        new_tree = compiler.compile_regulation(prev_tree, changes)
+        self.assertEqual(prev_json,
+                         NodeEncoder(sort_keys=True).encode(prev_tree))
+        self.assertEqual('new text', find(new_tree, '205-2-a').text)
+        self.assertIsNotNone(find(new_tree, '205-2-c'))
+        self.assertIsNone(find(new_tree, '205-4'))
+        # Only the modified paths were copied
+        self.assertIsNot(new_tree, prev_tree)
+        self.assertIs(find(new_tree, '205-1'), find(prev_tree, '205-1'))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import json
+
+from lxml import etree
+from mock import patch
+import pytest
+
+from regparser.tree import packed
+from regparser.tree.struct import (
+    FrozenNode, full_node_decode_hook, FullNodeEncoder, Node, NodeEncoder,
+    walk)
+
+
+def example_tree():
+    return Node(text=u'Root – text', label=['1000'], title='Part 1000',
+                children=[
+                    Node(text='(a) Child', label=['1000', 'a'],
+                         tagged_text='(a) <E T="03">Child</E>',
+                         source_xml=etree.fromstring('<P>(a) Child</P>')),
+                    Node(label=['1000', 'Subpart'],
+                         node_type=Node.EMPTYPART,
+                         children=[Node(text='Child', label=['1000', '1'])]),
+                    Node(text='Child', label=['1000', 'b'])])
+
+
+def test_round_trip():
+    """Decoding should match what we'd get from the JSON format"""
+    tree = example_tree()
+    encoded = packed.encode(tree)
+    assert packed.is_packed(encoded)
+    as_json = FullNodeEncoder().encode(tree)
+    assert not packed.is_packed(as_json.encode('utf-8'))
+
+    from_json = json.loads(as_json, object_hook=full_node_decode_hook)
+    decoded = packed.decode_full(encoded)
+    assert decoded == from_json == tree
+    assert decoded.title == 'Part 1000'
+    assert decoded.children[0].tagged_text == '(a) <E T="03">Child</E>'
+    assert etree.tounicode(decoded.children[0].source_xml) == (
+        '<P>(a) Child</P>')
+    assert not hasattr(decoded.children[2], 'tagged_text')
+    assert decoded.children[2].source_xml is None
+
+    # Also works on buffers
+    assert packed.decode_full(memoryview(encoded)) == tree
+    assert len(encoded) < len(as_json.encode('utf-8'))
+
+
+def test_frozen():
+    """Hashes needn't be computed until the nodes are compared"""
+    tree = example_tree()
+    encoded = packed.encode(tree)
+    with patch('regparser.tree.struct.node_digest') as node_digest:
+        frozen = packed.decode_frozen(encoded)
+        assert not node_digest.called
+    assert frozen._hash is None
+    assert frozen == FrozenNode.from_node(tree)
+
+
+def test_version():
+    """Unknown versions should be rejected rather than misread"""
+    encoded = bytearray(packed.encode(example_tree()))
+    encoded[len(packed.MAGIC)] = packed.VERSION + 1
+    with pytest.raises(ValueError):
+        packed.decode(bytes(encoded))
+    with pytest.raises(ValueError):
+        packed.decode(b'{"text": ""}')
+
+
+def test_lazy():
+    """Lazily decoded nodes should match the full decoding, only decoding
+    children when accessed"""
+    tree = example_tree()
+    encoded = packed.encode(tree)
+    lazy = packed.decode_lazy(encoded)
+    assert lazy._children is None
+    assert lazy == tree
+    assert [node.label_id() for node in walk(lazy, lambda node: node)] == [
+        node.label_id() for node in walk(tree, lambda node: node)]
+    assert lazy.children[0].tagged_text == '(a) <E T="03">Child</E>'
+    assert etree.tounicode(lazy.children[0].source_xml) == (
+        '<P>(a) Child</P>')
+    assert json.loads(NodeEncoder().encode(lazy)) == json.loads(
+        NodeEncoder().encode(tree))
+
+    lazy.children = lazy.children[:1]
+    assert len(lazy.children) == 1
+
+
+def test_lazy_subtree():
+    """Subtrees should be found via the label index"""
+    encoded = packed.encode(example_tree())
+    subtree = packed.decode_lazy(encoded, '1000-1')
+    assert subtree.label == ['1000', '1']
+    assert subtree.text == 'Child'
+    assert packed.decode_lazy(encoded, '1000-Subpart').children == [subtree]
+    assert packed.decode_lazy(encoded, '1000-2') is None
+
+
+def test_subtrees():
+    """Several subtrees can be found at once. Only the strings they need (and
+    those of their labels) should be decoded"""
+    tree = example_tree()
+    tree.children[2].label = ['1000', u'b–1']
+    subtrees = packed.decode_subtrees(packed.encode(tree), [
+        u'1000-b–1', '1000-Subpart', '1000-2', 'Child', '1000-S'])
+    assert subtrees == {u'1000-b–1': tree.children[2],
+                        '1000-Subpart': tree.children[1]}
+    assert subtrees['1000-Subpart'].children[0].text == 'Child'
+    decoded = subtrees['1000-Subpart']._packed._strings.values()
+    assert u'Root – text' not in decoded
+    assert '(a) Child' not in decoded
+
+
+def test_digests(settings):
+    """Stored digests should be used when decoding FrozenNodes, but only if
+    they were computed with the current algorithm"""
+    settings.EREGS_NODE_DIGEST = 'sha256'
+    tree = example_tree()
+    encoded = packed.encode(tree, digests=True)
+    assert len(encoded) > len(packed.encode(tree))
+    assert packed.decode_full(encoded) == tree
+    assert packed.decode_lazy(encoded, '1000-1').text == 'Child'
+
+    with patch('regparser.tree.struct.node_digest') as node_digest:
+        frozen = packed.decode_frozen(encoded)
+        assert not node_digest.called
+    expected = FrozenNode.from_node(tree)
+    assert frozen.hash == expected.hash
+    assert frozen.children[1].hash == expected.children[1].hash
+
+    settings.EREGS_NODE_DIGEST = 'md5'
+    frozen = packed.decode_frozen(encoded)
+    assert frozen.hash == FrozenNode.from_node(tree).hash
+    assert len(frozen.hash) == 32
@@ -1,6 +1,10 @@
+import gc
 import json
 from unittest import TestCase
 
+from django.test import override_settings
+from mock import patch
+
 from regparser.tree import struct
 from regparser.tree.depth.markers import MARKERLESS
 
@@ -63,6 +67,59 @@ class DepthTreeTest(TestCase):
         self.assertEqual([n1, n2, n4, n3], order)
         self.assertEqual(["1", "4", "3"], ret_val)
 
+    def test_iter_nodes(self):
+        n4 = struct.Node("4")
+        n2 = struct.Node("2", children=[n4])
+        n3 = struct.Node("3")
+        n1 = struct.Node("1", children=[n2, n3])
+
+        self.assertEqual([n1, n2, n4, n3], list(struct.iter_nodes(n1)))
+        self.assertEqual([n4, n2, n3, n1],
+                         list(struct.iter_nodes(n1, order='post')))
+        with self.assertRaises(ValueError):
+            list(struct.iter_nodes(n1, order='in'))
+
+        # Deep trees don't hit the recursion limit
+        root = node = struct.Node("0")
+        for i in range(5000):
+            node.children = [struct.Node(str(i + 1))]
+            node = node.children[0]
+        self.assertEqual(5001, len(list(struct.iter_nodes(root))))
+        self.assertEqual(node, struct.find_first(root,
+                                                 lambda n: n.text == "5000"))
+
+    def test_find_first_stops_early(self):
+        """Nodes after the match shouldn't be visited"""
+        root = struct.Node(label=['root'], children=[
+            struct.Node(label=['root', '1']),
+            struct.Node(label=['root', '2'])])
+        visited = []
+
+        def predicate(node):
+            visited.append(node.label_id())
+            return node.label_id() == 'root-1'
+        self.assertEqual(root.children[0], struct.find_first(root, predicate))
+        self.assertEqual(['root', 'root-1'], visited)
+
+    def test_attributes(self):
+        """Nodes are slotted; optional fields are only present when set"""
+        node = struct.Node('text', label=['1000', '1'])
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertFalse(hasattr(node, 'tagged_text'))
+        self.assertEqual(node.attributes(), {
+            'text': 'text', 'children': [], 'label': ['1000', '1'],
+            'title': None, 'node_type': struct.Node.REGTEXT,
+            'source_xml': None})
+        node.tagged_text = 'tagged'
+        self.assertEqual(node.attributes()['tagged_text'], 'tagged')
+        with self.assertRaises(AttributeError):
+            node.something_else = 1
+
+        # Label strings are shared between nodes
+        lhs = struct.Node(label=['1000', ''.join(['Appendix', 'A'])])
+        rhs = struct.Node(label=['1000', ''.join(['Append', 'ixA'])])
+        self.assertIs(lhs.label[1], rhs.label[1])
+
     def test_filter_walk(self):
         node = struct.Node(label="1", children=[struct.Node(label="3"),
                                                 struct.Node(label="5")])
@@ -186,6 +243,33 @@ class DepthTreeTest(TestCase):
             ])
         ])
 
+    def test_treeify_duplicates(self):
+        """Duplicate labels are merged into the first of them, keeping the
+        order of their children"""
+        n1 = struct.Node('first', label=['1'], children=[struct.Node('a')])
+        n1_dupe = struct.Node('second', label=['1'],
+                              children=[struct.Node('b')])
+        n1_again = struct.Node('third', label=['1'],
+                               children=[struct.Node('c')])
+        n1a = struct.Node(label=['1', 'a'])
+
+        result = struct.treeify([n1, n1a, n1_dupe, n1_again])
+        self.assertEqual(len(result), 1)
+        self.assertIs(result[0], n1)
+        self.assertEqual([c.text for c in n1.children], ['a', 'b', 'c', ''])
+        self.assertEqual(n1.children[-1].label, ['1', 'a'])
+
+    def test_treeify_wide(self):
+        """Many siblings shouldn't require comparing each pair"""
+        nodes = [struct.Node(label=['1'])]
+        nodes.extend(struct.Node(label=['1', str(i)]) for i in range(5000))
+        nodes.extend(struct.Node(label=['1', str(i), 'a'])
+                     for i in range(5000))
+        root, = struct.treeify(nodes)
+        self.assertEqual(len(root.children), 5000)
+        self.assertEqual(root.children[10].children[0].label,
+                         ['1', '10', 'a'])
+
 
 class FrozenNodeTests(TestCase):
     def test_comparison(self):
@@ -249,6 +333,63 @@ class FrozenNodeTests(TestCase):
         self.assertNotEqual(id(node1), id(node2))
         self.assertEqual(id(frozen1), id(frozen2))
 
+    def test_lazy_hash(self):
+        """Hashes are only computed when needed, unless provided"""
+        node = struct.FrozenNode(text='text', label=['1000', '1'])
+        self.assertIsNone(node._hash)
+        expected = struct.node_digest('text', '', '', '1000-1',
+                                      struct.Node.REGTEXT, [])
+        self.assertEqual(node.hash, expected)
+
+        node = struct.FrozenNode(text='text', digest='abcd')
+        self.assertEqual(node.hash, 'abcd')
+
+        with override_settings(EREGS_NODE_DIGEST='sha256'):
+            self.assertNotEqual(expected, struct.node_digest(
+                'text', '', '', '1000-1', struct.Node.REGTEXT, []))
+
+    def test_lazy_decode(self):
+        """Decoding shouldn't compute hashes. Once computed, identical
+        subtrees should be shared"""
+        encoded = struct.FullNodeEncoder().encode(struct.Node(
+            'text', label=['1000'], children=[
+                struct.Node('child', label=['1000', '1'])]))
+        with patch('regparser.tree.struct.node_digest') as node_digest:
+            node_digest.side_effect = lambda *args: repr(args)
+            first, second = [
+                json.loads(encoded,
+                           object_hook=struct.frozen_node_decode_hook)
+                for _ in range(2)]
+            self.assertFalse(node_digest.called)
+            self.assertIsNot(first.children[0], second.children[0])
+
+            self.assertEqual(first, second)
+            self.assertEqual(node_digest.call_count, 4)
+            self.assertIs(first.children[0], second.children[0])
+
+    def test_pool(self):
+        """Nodes are only pooled while something else refers to them"""
+        pool = struct.InternPool()
+        args = {'text': 'text', 'label': ['b', 'c']}
+        with patch.object(struct.FrozenNode, '_pool', pool):
+            first = struct.FrozenNode(**args)
+            second = struct.FrozenNode(**args)
+            self.assertIs(first.prototype(), first)
+            self.assertIs(second.prototype(), first)
+            self.assertEqual((len(pool), pool.hits, pool.misses), (1, 1, 1))
+
+            del first
+            gc.collect()
+            # Still referenced by the second node
+            self.assertEqual(len(pool), 1)
+            del second
+            gc.collect()
+            self.assertEqual(len(pool), 0)
+
+            third = struct.FrozenNode(**args)
+            self.assertIs(third.prototype(), third)
+            self.assertEqual((len(pool), pool.hits, pool.misses), (1, 1, 2))
+
     def test_hash(self):
         """Different fields lead to different hashes. The same fields lead to
         the same hash"""
@@ -272,3 +413,30 @@ class NodeTests(TestCase):
         self.assertTrue(struct.Node.is_markerless_label(['134', 'p33']))
         self.assertFalse(struct.Node.is_markerless_label(['245', '23']))
         self.assertTrue(struct.Node.is_markerless_label(['245', MARKERLESS]))
+
+    def test_node_equality(self):
+        """Nodes are compared by their fields, not their identity"""
+        def make():
+            return struct.Node('text', label=['1', '2'], title='title',
+                               children=[struct.Node('child', label=['1'])],
+                               tagged_text='tagged')
+        left, right = make(), make()
+        self.assertEqual(left, right)
+        self.assertFalse(left != right)
+        # tagged_text and source_xml aren't considered
+        right.tagged_text = 'other'
+        self.assertEqual(left, right)
+        right.children[0].text = 'other'
+        self.assertNotEqual(left, right)
+        right.children = left.children
+        self.assertEqual(left, right)
+        right.children = left.children + [struct.Node()]
+        self.assertNotEqual(left, right)
+        self.assertNotEqual(left, 'text')
+
+    def test_node_ordering(self):
+        nodes = [struct.Node(label=['1', '2']), struct.Node(label=['1']),
+                 struct.Node('b', label=['1', '2']),
+                 struct.Node('a', label=['1', '2'])]
+        self.assertEqual([n.label_id() + n.text for n in sorted(nodes)],
+                         ['1', '1-2', '1-2a', '1-2b'])